@@ -1,8 +1,10 @@
 import numpy as np
 try:  # added by Thijs for compatibility 
     import utils.utils_funcs as utils
+    import utils.paq2py as paq2py
 except ModuleNotFoundError:
     import utils_funcs as utils
+    import paq2py
 
 def stim_start_frame(paq, stim_chan_name):
 
@@ -10,8 +12,9 @@ def stim_start_frame(paq, stim_chan_name):
         
     '''
 
-    frame_clock = utils.paq_data(paq, 'frame_clock', threshold_ttl=True)
-    stim_times = utils.paq_data(paq, stim_chan_name, threshold_ttl=True)
+    edges = paq2py.paq_digital_edges(paq, ['frame_clock', stim_chan_name])
+    frame_clock = edges['frame_clock']
+    stim_times = edges[stim_chan_name]
 
     stim_times = [stim for stim in stim_times if stim < max(frame_clock)]
 
@@ -27,8 +30,9 @@ def stim_start_samples(paq, stim_chan_name):
 
     '''gets the sample number (from channel frame_clock) that a stim occured on'''
 
-    frame_clock = paq_data(paq, 'frame_clock', threshold_ttl=True)
-    stim_times = paq_data(paq, stim_chan_name, threshold_ttl=True)
+    edges = paq2py.paq_digital_edges(paq, ['frame_clock', stim_chan_name])
+    frame_clock = edges['frame_clock']
+    stim_times = edges[stim_chan_name]
 
     stim_times = [stim for stim in stim_times if stim < max(frame_clock)]
 
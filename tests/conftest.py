@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the modules in utils import each other by bare name as well as through
+# the utils package, so both the repo root and utils need to be importable
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'utils')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('skimage')
+pytest.importorskip('scipy')
+
+import artifact_removal
+from movie_source import MemmapMovie
+
+
+class ListWriter():
+
+    def __init__(self):
+        self.blocks = []
+
+    def write(self, frames):
+        self.blocks.append(np.array(frames))
+
+    @property
+    def movie(self):
+        return np.concatenate(self.blocks)
+
+
+def make_stack(n_frames=60):
+    stack = np.random.RandomState(1).randint(
+        0, 100, (n_frames, 16, 16)).astype(np.uint16)
+    stack[30:35, 4, :] = 1000
+    return stack
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 500])
+def test_stream_threshold(block_size):
+    stack = make_stack()
+    frames = list(range(3, 29, 2))
+    thresh = artifact_removal.stream_threshold(stack, frames, 2, block_size)
+    expected = artifact_removal.find_threshold(stack, frames, 2)
+    assert np.allclose(thresh, expected)
+
+
+def test_stream_matches_in_memory():
+    stack = make_stack()
+    writer = ListWriter()
+    artifact_removal.artifact_removal_stream(stack, writer, range(0, 29),
+                                             range(30, 35), block_size=7)
+    expected = artifact_removal.artifact_removal(
+        stack.copy(), thresh_list=range(0, 29), remove_me=range(30, 35))
+    assert np.array_equal(writer.movie, expected)
+    assert writer.movie[30:35, 4].max() < 1000
+
+
+def test_stream_planes():
+    stack = make_stack()
+    writer = ListWriter()
+    artifact_removal.artifact_removal_stream(MemmapMovie(stack), writer,
+                                             range(0, 29), range(30, 35),
+                                             nplanes=2, block_size=7)
+    # baseline frames are the frames of thresh_list in the same plane
+    expected = stack.copy()
+    for f in range(30, 35):
+        thresh = artifact_removal.find_threshold(stack, range(f % 2, 29, 2), 2)
+        frame_bin = artifact_removal.binarise_frame(stack[f], thresh)
+        expected[f] = artifact_removal.process_frame(stack[f], frame_bin)
+    assert np.array_equal(writer.movie, expected)
+
+
+def test_stream_plane_without_baseline():
+    stack = make_stack()
+    with pytest.raises(ValueError):
+        artifact_removal.artifact_removal_stream(stack, ListWriter(),
+                                                 [0, 2, 4], range(30, 35),
+                                                 nplanes=2)
@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import local_cache
+
+
+@pytest.fixture
+def remote(tmp_path):
+    folder = tmp_path / 'remote' / 'Data' / '2020-01-01'
+    folder.mkdir(parents=True)
+    paths = []
+    for i in range(4):
+        path = folder / 'f{}.paq'.format(i)
+        path.write_bytes(os.urandom(1000))
+        paths.append(str(path))
+    return str(tmp_path / 'remote' / 'Data'), paths
+
+
+def make_store(tmp_path, remote_root, budget_bytes=10**6):
+    return local_cache.LocalStore(root=str(tmp_path / 'local'),
+                                  budget_gb=budget_bytes / 2**30,
+                                  remote_root=remote_root)
+
+
+def test_fetch_and_resolve(tmp_path, remote):
+    remote_root, paths = remote
+    store = make_store(tmp_path, remote_root)
+
+    assert store.resolve(paths[0]) == paths[0]
+    local = store.fetch(paths[0])
+    assert local == os.path.join(store.root, 'Data', '2020-01-01', 'f0.paq')
+    assert store.resolve(paths[0]) == local
+    with open(local, 'rb') as f, open(paths[0], 'rb') as g:
+        assert f.read() == g.read()
+
+
+def test_changed_remote_is_refetched(tmp_path, remote):
+    remote_root, paths = remote
+    store = make_store(tmp_path, remote_root)
+    local = store.fetch(paths[0])
+
+    with open(paths[0], 'ab') as f:
+        f.write(b'more')
+    assert store.resolve(paths[0]) == paths[0]
+    assert store.fetch(paths[0], verify=True) == local
+    assert os.path.getsize(local) == 1004
+
+
+def test_lru_eviction(tmp_path, remote):
+    remote_root, paths = remote
+    store = make_store(tmp_path, remote_root, budget_bytes=2500)
+
+    store.fetch(paths[0])
+    store.fetch(paths[1])
+    store.resolve(paths[0])  # paths[1] is now the least recently used
+    store.fetch(paths[2])
+
+    cached = sorted(os.path.basename(entry['local_path'])
+                    for entry in store._load_index().values())
+    assert cached == ['f0.paq', 'f2.paq']
+    assert not os.path.exists(store.local_path(paths[1]))
+
+
+def _fetch_all(root, remote_root, paths):
+    store = local_cache.LocalStore(root=root, remote_root=remote_root)
+    return [store.fetch(path) for path in paths]
+
+
+def test_processes_share_the_index(tmp_path, remote):
+    remote_root, paths = remote
+    root = str(tmp_path / 'local')
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(_fetch_all, root, remote_root,
+                               paths[i:] + paths[:i])
+                   for i in range(len(paths))]
+        results = [future.result() for future in futures]
+
+    store = local_cache.LocalStore(root=root, remote_root=remote_root)
+    index = store._load_index()
+    assert sorted(index) == sorted(os.path.abspath(p) for p in paths)
+    assert all(store.resolve(path) == results[0][i]
+               for i, path in enumerate(paths))
+
+
+def test_outside_remote_root(tmp_path, remote):
+    remote_root, _ = remote
+    other = tmp_path / 'elsewhere.txt'
+    other.write_text('x')
+    store = make_store(tmp_path, remote_root)
+    local = store.fetch(str(other))
+    assert local.startswith(os.path.join(store.root, 'other'))
+    assert local.endswith('elsewhere.txt')
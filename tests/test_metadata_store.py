@@ -0,0 +1,107 @@
+import os
+import threading
+
+import pytest
+
+import metadata_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    return metadata_store.MetadataStore(str(tmp_path / 'db' / 'md.sqlite'))
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = []
+    for i in range(5):
+        path = tmp_path / 'f{}.xml'.format(i)
+        path.write_text('x' * (i + 1))
+        paths.append(str(path))
+    return paths
+
+
+class CountingParser():
+
+    def __init__(self):
+        self.parsed = []
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        with self._lock:
+            self.parsed.append(path)
+        return {'size': os.path.getsize(path), 'name': os.path.basename(path)}
+
+
+def test_lookup_parses_once(store, files):
+    parser = CountingParser()
+    first = store.lookup_many('pv', files, parser)
+    assert [value['size'] for value in first] == [1, 2, 3, 4, 5]
+    assert sorted(parser.parsed) == sorted(files)
+
+    parser.parsed = []
+    assert store.lookup_many('pv', files, parser) == first
+    assert parser.parsed == []
+
+
+def test_changed_file_is_reparsed(store, files):
+    parser = CountingParser()
+    store.lookup_many('pv', files, parser)
+
+    with open(files[2], 'a') as f:
+        f.write('more')
+    parser.parsed = []
+    values = store.lookup_many('pv', files, parser, max_workers=4)
+    assert parser.parsed == [files[2]]
+    assert values[2]['size'] == 7
+
+
+def test_version_and_kind_are_separate(store, files):
+    parser = CountingParser()
+    store.lookup('pv', files[0], parser)
+    store.lookup('pv', files[0], parser, version=2)
+    store.lookup('tiff', files[0], parser)
+    assert parser.parsed == [files[0]] * 3
+    assert store.get('pv', files[0], version=2) is not None
+    assert store.get('pv', files[0], version=3) is None
+
+
+def test_repeated_and_missing_paths(store, files, tmp_path):
+    parser = CountingParser()
+    values = store.lookup_many('pv', [files[0], files[1], files[0]], parser)
+    assert values[0] == values[2]
+    assert len(parser.parsed) == 2
+    assert store.get('pv', str(tmp_path / 'missing.xml')) is None
+
+
+def test_entries_and_remove(store, files):
+    store.set_many('naparm', {path: i for i, path in enumerate(files)})
+    entries = store.entries('naparm')
+    assert entries == {os.path.abspath(path): i
+                       for i, path in enumerate(files)}
+
+    store.remove('naparm', files[0])
+    assert os.path.abspath(files[0]) not in store.entries('naparm')
+    assert store.get('naparm', files[0]) is None
+    assert store.get('naparm', files[1]) == 1
+
+
+def test_many_paths_in_one_query(store, tmp_path):
+    paths = []
+    for i in range(metadata_store.QUERY_CHUNK + 50):
+        path = tmp_path / 'many' / '{}.gpl'.format(i)
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(str(i))
+        paths.append(str(path))
+    store.set_many('gpl', {path: i for i, path in enumerate(paths)})
+    found = store.get_many('gpl', paths)
+    assert [found[path] for path in paths] == list(range(len(paths)))
+
+
+def test_unusable_database_only_costs_parsing(tmp_path, files):
+    blocker = tmp_path / 'not_a_dir'
+    blocker.write_text('')
+    store = metadata_store.MetadataStore(str(blocker / 'md.sqlite'))
+    parser = CountingParser()
+    values = store.lookup_many('pv', files, parser)
+    assert [value['size'] for value in values] == [1, 2, 3, 4, 5]
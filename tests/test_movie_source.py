@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+import tifffile
+
+import movie_source
+
+
+@pytest.fixture
+def s2p_plane(tmp_path):
+    plane = tmp_path / 'suite2p' / 'plane0'
+    plane.mkdir(parents=True)
+    movie = np.random.RandomState(2).randint(
+        -300, 3000, (50, 16, 24)).astype(np.int16)
+    movie.tofile(str(plane / 'data.bin'))
+    ops = {'Ly': 16, 'Lx': 24, 'nframes': 50, 'reg_file': '/gone/data.bin',
+           'frames_per_folder': np.array([20, 5, 25])}
+    np.save(str(plane / 'ops.npy'), ops)
+    return str(plane), ops, movie
+
+
+@pytest.mark.parametrize('which', ['folder', 'ops.npy', 'data.bin'])
+def test_suite2p_bin_paths(s2p_plane, which):
+    plane, ops, movie = s2p_plane
+    path = plane if which == 'folder' else os.path.join(plane, which)
+
+    loaded = movie_source.Suite2pBinMovie(path)
+    given_ops = movie_source.Suite2pBinMovie(path, ops=ops)
+
+    for s2p in (loaded, given_ops):
+        assert s2p.bin_path == os.path.join(plane, 'data.bin')
+        assert s2p.shape == movie.shape
+        assert np.array_equal(s2p[:], movie)
+
+
+def test_suite2p_folder_movie(s2p_plane):
+    plane, _, movie = s2p_plane
+    s2p = movie_source.open_movie(plane)
+    assert isinstance(s2p, movie_source.Suite2pBinMovie)
+    assert list(s2p.frame_offsets) == [0, 20, 25, 50]
+    assert s2p.folder_frames(1) == range(20, 25)
+
+    folder = s2p.folder_movie(2)
+    assert np.array_equal(folder.get_frames([0, 24, 3]), movie[[25, 49, 28]])
+    assert np.shares_memory(folder.movie, s2p.movie)
+
+
+def test_suite2p_missing_bin(s2p_plane):
+    plane, ops, _ = s2p_plane
+    os.remove(os.path.join(plane, 'data.bin'))
+    with pytest.raises(FileNotFoundError):
+        movie_source.Suite2pBinMovie(plane, ops=ops)
+
+
+@pytest.fixture
+def cache_root(tmp_path, monkeypatch):
+    monkeypatch.setenv('VAPE_CACHE', str(tmp_path / 'cache'))
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'bigtiff': True},
+                                    {'byteorder': '>'}, {'imagej': True}])
+def test_tiff_movie(tmp_path, cache_root, kwargs):
+    movie = np.random.RandomState(3).randint(
+        0, 4000, (12, 10, 14)).astype(np.uint16)
+    tiff_path = str(tmp_path / 'movie.tif')
+    tifffile.imwrite(tiff_path, movie, **kwargs)
+
+    for _ in range(2):  # the second open reads the cached index
+        tiff = movie_source.TiffMovie(tiff_path)
+        assert tiff.shape == movie.shape
+        assert tiff.direct
+        assert np.array_equal(tiff[:], movie)
+        assert np.array_equal(tiff.get_frames([11, 0, 5, 5]),
+                              movie[[11, 0, 5, 5]])
+        tiff.close()
+
+
+def test_tiff_movie_pages_outside_series(tmp_path, cache_root):
+    tiff_path = str(tmp_path / 'mixed.tif')
+    tifffile.imwrite(tiff_path, np.zeros((5, 10, 14), np.uint16),
+                     metadata=None)
+    tifffile.imwrite(tiff_path, np.zeros((3, 4), np.uint8), append=True,
+                     metadata=None)
+    with pytest.raises(ValueError):
+        movie_source.TiffMovie(tiff_path)
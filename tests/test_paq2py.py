@@ -0,0 +1,143 @@
+import os
+
+import numpy as np
+import pytest
+
+import paq2py
+
+CHAN_NAMES = ['frame_clock', 'pycontrol_rsync', 'x_galvo_uncaging',
+              'slm2packio']
+
+
+def write_paq(path, data, chan_names, rate=20000):
+    '''PackIO .paq: big-endian float32 header then interleaved samples'''
+    values = [rate, len(chan_names)]
+    for strings in (chan_names, ['ai{}'.format(i)
+                                 for i in range(len(chan_names))],
+                    ['V'] * len(chan_names)):
+        for string in strings:
+            values.append(len(string))
+            values.extend(ord(c) for c in string)
+    with open(path, 'wb') as f:
+        np.array(values, dtype='>f4').tofile(f)
+        np.asarray(data, dtype='>f4').T.copy().tofile(f)
+
+
+def make_data(n_samples=50000, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(n_samples)
+    frame_clock = ((t % 667) < 50) * 5 + rng.normal(0, .05, n_samples)
+    rsync = ((t % 9001) < 300) * 5.
+    galvo = np.full(n_samples, -1.) + rng.normal(0, .01, n_samples)
+    slm = ((t % 4000) < 100) * 5.
+    # high on the first sample and on the last
+    slm[:3] = 5
+    slm[-2:] = 5
+    return np.vstack([frame_clock, rsync, galvo, slm]).astype(np.float32)
+
+
+def reference_edges(signal, threshold):
+    '''as utils_funcs.threshold_detect'''
+    high = signal > threshold
+    high[1:][high[:-1] & high[1:]] = False
+    return np.where(high)[0]
+
+
+@pytest.fixture
+def paq_path(tmp_path):
+    path = str(tmp_path / 'session.paq')
+    write_paq(path, make_data(), CHAN_NAMES)
+    return path
+
+
+def test_threshold_detect_matches_reference():
+    utils_funcs = pytest.importorskip('utils_funcs')
+    data = make_data()
+    for signal in data:
+        assert np.array_equal(utils_funcs.threshold_detect(signal, 1),
+                              reference_edges(signal, 1))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 666, 667, 4000, 2**20])
+def test_threshold_detect_chunked(chunk_size):
+    for signal in make_data():
+        edges = paq2py.threshold_detect_chunked(signal, 1, chunk_size)
+        assert edges.dtype == np.int64
+        assert np.array_equal(edges, reference_edges(signal, 1))
+    # a (samples, 1) column is read as its first column
+    signal = make_data()[3][:, None]
+    assert np.array_equal(paq2py.threshold_detect_chunked(signal, 1, 999),
+                          reference_edges(signal[:, 0], 1))
+
+
+def test_paq_read(paq_path):
+    paq = paq2py.paq_read(paq_path)
+    assert paq['chan_names'] == CHAN_NAMES
+    assert paq['rate'] == 20000
+    assert np.array_equal(paq['data'], make_data())
+
+
+@pytest.mark.parametrize('make_sidecar', [False, True])
+@pytest.mark.parametrize('chunk_size', [777, 2**20])
+def test_paq_digital_edges(paq_path, make_sidecar, chunk_size):
+    data = make_data()
+    paq = paq2py.PaqFile(paq_path, make_sidecar=make_sidecar)
+    assert paq.has_sidecar == make_sidecar
+
+    names = ['frame_clock', 'slm2packio', 'pycontrol_rsync']
+    edges = paq2py.paq_digital_edges(paq, names, [1, 2, 1],
+                                     chunk_size=chunk_size)
+    for name, threshold in zip(names, [1, 2, 1]):
+        expected = reference_edges(data[CHAN_NAMES.index(name)], threshold)
+        assert np.array_equal(edges[name], expected)
+
+    # the same edges from the paq_read dict and, cached, from paq_edges
+    as_dict = paq2py.paq_digital_edges(paq2py.paq_read(paq_path), names,
+                                       [1, 2, 1])
+    for name in names:
+        assert np.array_equal(as_dict[name], edges[name])
+    assert np.array_equal(paq2py.paq_edges(paq_path, 'slm2packio', 2),
+                          edges['slm2packio'])
+
+
+def test_sidecar_channels(paq_path):
+    paq2py.paq_to_sidecar(paq_path)
+    assert os.path.isdir(paq_path + '.vape')
+
+    paq = paq2py.PaqFile(paq_path)
+    assert paq.has_sidecar
+    data = make_data()
+    for i, name in enumerate(CHAN_NAMES):
+        assert np.array_equal(paq.channel(name)[:], data[i])
+    assert np.array_equal(paq2py.paq_read(paq_path)['data'], data)
+
+
+def test_sidecar_dropped_when_paq_changes(paq_path):
+    paq2py.paq_edges(paq_path, 'frame_clock')
+    paq2py.paq_to_sidecar(paq_path)
+
+    data = make_data(seed=1)
+    data[0] = 0
+    write_paq(paq_path, data, CHAN_NAMES)
+    os.utime(paq_path, ns=(0, 10**9))
+
+    assert not paq2py.PaqFile(paq_path).has_sidecar
+    assert len(paq2py.paq_edges(paq_path, 'frame_clock')) == 0
+    assert np.array_equal(paq2py.paq_read(paq_path)['data'], data)
+
+
+def test_paq_session(tmp_path):
+    data = make_data()
+    splits = [0, 12345, 30000, data.shape[1]]
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / 'part{}.paq'.format(i))
+        write_paq(path, data[:, splits[i]:splits[i+1]], CHAN_NAMES)
+        paths.append(path)
+
+    session = paq2py.open_paq(paths)
+    assert isinstance(session, paq2py.PaqSession)
+    edges = paq2py.paq_digital_edges(session, ['frame_clock', 'slm2packio'])
+    for name in ['frame_clock', 'slm2packio']:
+        signal = data[CHAN_NAMES.index(name)]
+        assert np.array_equal(edges[name], reference_edges(signal, 1))
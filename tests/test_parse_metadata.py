@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('utils.gsheets_importer')
+
+from utils import parse_metadata
+
+SHARD = ('<PVStateShard>'
+         '<PVStateValue key="activeMode" value="Galvo"/>'
+         '<PVStateValue key="framePeriod" value="0.033"/>'
+         '<PVStateValue key="pixelsPerLine" value="512"/>'
+         '<PVStateValue key="laserPower">'
+         '<IndexedValue index="0" value="50" description="Imaging"/>'
+         '<IndexedValue index="1" value="3" description="Uncaging"/>'
+         '</PVStateValue>'
+         '<PVStateValue key="micronsPerPixel">'
+         '<IndexedValue index="XAxis" value="1.1"/>'
+         '<IndexedValue index="YAxis" value="1.2"/>'
+         '</PVStateValue>'
+         '</PVStateShard>')
+
+
+def write_xml(path, zseries=False, n_sequences=1, n_frames=20,
+              frame_period=0.0333):
+    '''PrairieView-like xml, relativeTime restarts with each Sequence'''
+    out = ['<?xml version="1.0"?><PVScan version="5.4">', SHARD]
+    absolute = 0.
+    for cycle in range(n_sequences):
+        out.append('<Sequence type="{}" cycle="{}">'.format(
+            'TSeries ZSeries Element' if zseries else
+            'TSeries Timed Element', cycle + 1))
+        for i in range(n_frames):
+            relative = i * frame_period
+            absolute += frame_period
+            out.append(
+                '<Frame relativeTime="{:.6f}" absoluteTime="{:.6f}" '
+                'index="{}"><File channel="3" filename="f_{:06d}.ome.tif"/>'
+                '<ExtraParameters lastGoodFrame="0"/>'
+                '<PVStateShard><PVStateValue key="framePeriod" '
+                'value="0.0334"/></PVStateShard></Frame>'.format(
+                    relative, absolute, i + 1, i + 1))
+        out.append('</Sequence>')
+    out.append('</PVScan>')
+    with open(path, 'w') as f:
+        f.write(''.join(out))
+
+
+@pytest.fixture
+def cache_root(tmp_path, monkeypatch):
+    # a fresh metadata store and sidecars under tmp_path
+    from utils import metadata_store
+    monkeypatch.setenv('VAPE_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.setattr(metadata_store, '_store', None)
+
+
+def test_pv_state_shard(tmp_path):
+    path = str(tmp_path / 't.xml')
+    write_xml(path)
+
+    assert parse_metadata.getPVStateShard(path, 'framePeriod')[0] == '0.033'
+    value, description, index = parse_metadata.getPVStateShard(
+        path, 'laserPower')
+    assert value == ['50', '3']
+    assert description == ['Imaging', 'Uncaging']
+    assert index == ['0', '1']
+    # keys of subelements give the value of the element they are in
+    assert parse_metadata.getPVStateShard(path, 'micronsPerPixel')[0] == \
+        ['1.1', '1.2']
+    with pytest.raises(Exception):
+        parse_metadata.getPVStateShard(path, 'notAKey')
+
+
+def test_shard_cache_follows_the_file(tmp_path):
+    path = str(tmp_path / 't.xml')
+    write_xml(path)
+    first = parse_metadata.loadPVStateShard(path)
+    assert parse_metadata.loadPVStateShard(path) is first
+
+    with open(path) as f:
+        text = f.read()
+    with open(path, 'w') as f:
+        f.write(text.replace('"0.033"', '"0.066"'))
+    os.utime(path, ns=(0, 10**9))
+
+    assert parse_metadata.getPVStateShard(path, 'framePeriod')[0] == '0.066'
+    info = parse_metadata._parsePVStateShard.cache_info()
+    assert info.maxsize == parse_metadata.SHARD_CACHE_SIZE
+    assert info.currsize <= parse_metadata.SHARD_CACHE_SIZE
+
+
+def test_scan_pv_xml(tmp_path):
+    path = str(tmp_path / 't.xml')
+    write_xml(path, n_sequences=3, n_frames=10)
+    meta = parse_metadata.scanPVxml(path)
+
+    assert meta['acq_type'] == 'TSeries Timed Element'
+    assert meta['n_sequences'] == 3
+    assert meta['n_seq_frames'] == 10
+    assert meta['last_cycle'] == '3'
+    assert meta['last_frame_index'] == '10'
+    assert meta['last_good_frame'] == '0'
+    assert meta['shard'].get('pixelsPerLine')[0] == '512'
+    assert meta['last_frame_shard'].get('framePeriod')[0] == '0.0334'
+
+
+def test_read_pv_xmls(tmp_path, cache_root):
+    paths = [str(tmp_path / '{}.xml'.format(i)) for i in range(3)]
+    for i, path in enumerate(paths):
+        write_xml(path, n_frames=5 + i)
+
+    for _ in range(2):  # scanned then read back from the store
+        metas = parse_metadata.readPVxmls(paths + paths[:1])
+        assert [meta['n_seq_frames'] for meta in metas] == [5, 6, 7, 5]
+        assert metas[0]['shard'].get('framePeriod')[0] == '0.033'
+        assert metas[0] is not metas[3]
+
+
+def test_frame_times(tmp_path, cache_root):
+    path = str(tmp_path / 'z.xml')
+    write_xml(path, zseries=True, n_sequences=4, n_frames=3)
+
+    times = parse_metadata.readPVframeTimes(path)
+    assert len(times) == 12
+    assert list(times['plane']) == [0, 1, 2] * 4
+    assert list(times['cycle']) == [0] * 3 + [1] * 3 + [2] * 3 + [3] * 3
+    assert np.all(np.diff(times['absolute_time']) > 0)
+
+    cached = parse_metadata.readPVframeTimes(path, plane=1)
+    assert np.array_equal(cached, times[times['plane'] == 1])
@@ -0,0 +1,126 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import tifffile
+from concurrent.futures import ThreadPoolExecutor
+
+import tiff_convert
+
+
+N_FRAMES = 40
+
+
+def make_tseries(folder, n_frames=N_FRAMES):
+    '''PrairieView-like tseries of single page Ch2 and Ch3 tiffs'''
+    name = os.path.basename(folder)
+    os.makedirs(folder)
+    movie = np.random.RandomState(0).randint(
+        0, 4000, (n_frames, 8, 12)).astype(np.uint16)
+    xml = ['<PVScan><Sequence type="TSeries Timed Element">']
+    for i in range(n_frames):
+        files = ''
+        for channel, frame in (('Ch2', movie[i] // 2), ('Ch3', movie[i])):
+            fname = '{}_Cycle00001_{}_{:06d}.ome.tif'.format(name, channel,
+                                                             i + 1)
+            tifffile.imwrite(os.path.join(folder, fname), frame)
+            files += '<File channel="{}" filename="{}"/>'.format(
+                channel[-1], fname)
+        xml.append('<Frame index="{}">{}</Frame>'.format(i + 1, files))
+    xml.append('</Sequence></PVScan>')
+    with open(os.path.join(folder, name + '.xml'), 'w') as f:
+        f.write(''.join(xml))
+    return movie
+
+
+@pytest.fixture
+def tseries(tmp_path):
+    folder = str(tmp_path / 'TSeries-001')
+    return folder, make_tseries(folder)
+
+
+def test_consolidate_keeps_originals(tseries):
+    folder, movie = tseries
+    output = tiff_convert.consolidate_tseries(folder, chunk_size=16,
+                                              processes=1)
+    assert np.array_equal(tifffile.imread(output), movie)
+    assert len(tiff_convert.single_page_tiffs(folder)) == N_FRAMES
+    assert tiff_convert.consolidation_verified(output)
+
+
+def test_consolidate_delete(tseries):
+    folder, movie = tseries
+    output = tiff_convert.consolidate_tseries(folder, chunk_size=16,
+                                              processes=1, delete=True)
+    assert np.array_equal(tifffile.imread(output), movie)
+    assert tiff_convert.single_page_tiffs(folder) == []
+    # only the consolidated channel is deleted
+    assert len(tiff_convert.single_page_tiffs(folder, 'Ch2')) == N_FRAMES
+
+
+def test_delete_checks_every_frame(tseries, monkeypatch):
+    folder, movie = tseries
+    # a frame outside any spot check differs from its single page tiff
+    bad = tiff_convert.single_page_tiffs(folder)[N_FRAMES // 2 + 3]
+    write_chunk = tiff_convert._write_chunk
+
+    def corrupting_write(output_path, tiff_paths, start):
+        write_chunk(output_path, tiff_paths, start)
+        if bad in tiff_paths:
+            out = tifffile.memmap(output_path, mode='r+')
+            out[start + tiff_paths.index(bad)] += 1
+            out.flush()
+            del out
+        return start
+
+    monkeypatch.setattr(tiff_convert, '_write_chunk', corrupting_write)
+    monkeypatch.setattr(tiff_convert, 'ProcessPoolExecutor',
+                        ThreadPoolExecutor)
+
+    with pytest.raises(AssertionError):
+        tiff_convert.consolidate_tseries(folder, chunk_size=16, processes=1,
+                                         delete=True)
+    assert len(tiff_convert.single_page_tiffs(folder)) == N_FRAMES
+
+
+def test_resume_interrupted_delete(tseries):
+    folder, movie = tseries
+    output = tiff_convert.consolidate_tseries(folder, chunk_size=16,
+                                              processes=1)
+    tiffs = tiff_convert.single_page_tiffs(folder)
+    for path in tiffs[:N_FRAMES // 2]:
+        os.remove(path)
+
+    assert tiff_convert.consolidate_tseries(folder, delete=True) == output
+    assert tiff_convert.single_page_tiffs(folder) == []
+    assert np.array_equal(tifffile.imread(output), movie)
+
+
+def test_resume_interrupted_copy(tseries):
+    folder, movie = tseries
+    output = tiff_convert.consolidate_tseries(folder, chunk_size=16,
+                                              processes=1)
+    progress_path = output + '.progress.json'
+    with open(progress_path) as f:
+        progress = json.load(f)
+    progress['done'] = progress['done'][:1]
+    progress['verified'] = False
+    with open(progress_path, 'w') as f:
+        json.dump(progress, f)
+    out = tifffile.memmap(output, mode='r+')
+    out[16:] = 0
+    del out
+
+    assert not tiff_convert.consolidation_verified(output)
+    tiff_convert.consolidate_tseries(folder, chunk_size=16, processes=1)
+    assert np.array_equal(tifffile.imread(output), movie)
+
+
+def test_verified_output_missing(tseries):
+    folder, _ = tseries
+    output = tiff_convert.consolidate_tseries(folder, processes=1)
+    os.remove(output)
+    with pytest.raises(FileNotFoundError):
+        tiff_convert.consolidate_tseries(folder, processes=1, delete=True)
+    assert len(tiff_convert.single_page_tiffs(folder)) == N_FRAMES
@@ -14,7 +14,7 @@ except ImportError:
     from tkinter import filedialog
 
 
-def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbose=False):
+def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbose=False, mmap=False):
 	'''
 	Input
 	-----
@@ -28,11 +28,14 @@ def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbos
 		the total number of frames to read
 	verbose : bool, optional
 		choose whether to display output progress and stats
+	mmap : bool, optional
+		memory-map the requested frames rather than reading them, frames
+		are only loaded from disk when indexed
 
 	Output
 	------
 	data : np.ndarray
-		frames x rows x cols array (dtype=np.uint16)
+		frames x rows x cols array (dtype=np.uint16), np.memmap if mmap
 	'''
 
 	# open file diaog if input not provided
@@ -76,11 +79,14 @@ def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbos
 		# Read data
 		start_on_byte = (((start-1) * samples_per_frame)+2) *2  # plus 2 because header size, x2 because 1 uint16 is 2 bytes
 		num_chars_to_read = (num_frames * samples_per_frame)  # note size in bytes of char defined by fread function argument
-		f.seek(start_on_byte, 0) 
-		data = np.fromfile(f, dtype=np.uint16, count=num_chars_to_read)
+		if mmap:
+			data = np.memmap(movie_path, dtype=np.uint16, mode='r', offset=start_on_byte, shape=(num_frames, lines_per_frame, pixels_per_line), order='C')
+		else:
+			f.seek(start_on_byte, 0) 
+			data = np.fromfile(f, dtype=np.uint16, count=num_chars_to_read)
 
-	# Reshape data into frame array
-	data = data.reshape(num_frames, lines_per_frame, pixels_per_line, order='C')
+			# Reshape data into frame array
+			data = data.reshape(num_frames, lines_per_frame, pixels_per_line, order='C')
 
 	if verbose:
 		print('Data size: ' + str(data.shape[0]) + ' frames (' + str(data.shape[1]) + ', ' + str(data.shape[2]) + ')')
@@ -92,6 +98,32 @@ def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbos
 	return data
 
 
+def IterFrameBlocks(movie_path, block_size=100, start=1, stop=np.Inf):
+	'''
+	Input
+	-----
+	movie_path : string
+		full path to *.bin file
+	block_size : int, optional
+		number of frames in each block
+	start : int, optional
+		the first frame to begin reading from
+	stop : int, optional
+		the frame to stop reading at
+
+	Output
+	------
+	generator of (first frame index, block) where block is a
+	frames x rows x cols array (dtype=np.uint16) of at most block_size
+	frames, only one block is held in memory at a time
+	'''
+
+	movie = ReadRawFile(movie_path, start=start, stop=stop, mmap=True)
+
+	for i in range(0, movie.shape[0], block_size):
+		yield start - 1 + i, np.array(movie[i:i+block_size])
+
+
 def WriteRawFile(data, file_name):
 	# construct filename
 	if not file_name[-4:] == '.bin':
@@ -107,3 +139,55 @@ def WriteRawFile(data, file_name):
 		
 		# write the data
 		data.tofile(raw_file)
+
+
+class RawFileWriter():
+	'''
+	Writes a PrairieLink *.bin movie a block of frames at a time, so movies
+	larger than memory can be streamed to disk. The header is written up
+	front as the frame size is known before any frames
+
+	Input
+	-----
+	file_name : string
+		path of the *.bin file to write
+	lines_per_frame, pixels_per_line : int
+		frame size
+
+	Use as a context manager or call Close() when done:
+		with RawFileWriter(file_name, 512, 512) as writer:
+			for block in blocks:
+				writer.Write(block)
+	'''
+
+	def __init__(self, file_name, lines_per_frame, pixels_per_line):
+		if not file_name[-4:] == '.bin':
+			file_name = file_name + '.bin'
+
+		self.file_name = file_name
+		self.frame_shape = (lines_per_frame, pixels_per_line)
+		self.num_frames = 0
+
+		self.raw_file = open(file_name, 'wb')
+		# write the header in the order ReadRawFile reads it
+		np.uint16(pixels_per_line).tofile(self.raw_file)
+		np.uint16(lines_per_frame).tofile(self.raw_file)
+
+	def Write(self, frames):
+		# frames : frames x rows x cols block, or a single frame
+		frames = np.asarray(frames, dtype=np.uint16).reshape((-1,) + self.frame_shape)
+		frames.tofile(self.raw_file)
+		self.num_frames += frames.shape[0]
+
+	def Close(self):
+		self.raw_file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.Close()
+
+	# lower case names shared with movie_source.TiffStackWriter
+	write = Write
+	close = Close
@@ -17,7 +17,7 @@ from scipy.ndimage.filters import gaussian_filter1d, gaussian_filter
 import time
 import tensorflow as tf
 
-from utils import sta, PrairieLink, paq2py, ThorLink
+from utils import sta, PrairieLink, paq2py, ThorLink, movie_source
 from skimage import exposure
 
 
@@ -69,10 +69,12 @@ class STAMovieMaker():
         sync_ext = os.path.splitext(self.p['syncPath'])[1]
         if sync_ext == '.paq':
             try:
-                paq = paq2py.paq_read(self.p['syncPath'], plot=False)
-                frame_trace = paq['data'][paq['chan_names'].index(sync_frame_channel)]
-                stim_trace = paq['data'][paq['chan_names'].index(sync_stim_channel)]
-                rate = paq['rate']
+                paq = paq2py.PaqFile(self.p['syncPath'])
+                frame_edges = paq2py.threshold_detect_chunked(
+                    paq.channel(sync_frame_channel), 1)
+                stim_edges = paq2py.threshold_detect_chunked(
+                    paq.channel(sync_stim_channel), 1)
+                rate = paq.rate
 
             except:
                 print('Error. Channel names: ' + str(paq['chan_names']))
@@ -80,9 +82,10 @@ class STAMovieMaker():
 
         elif sync_ext == '.h5':
             sync_data = ThorLink.ReadSyncFile(self.p['syncPath'],
-                    datasets=[sync_frame_channel, sync_stim_channel], listdatasets=True)
-            frame_trace = sync_data[sync_frame_channel]
-            stim_trace = sync_data[sync_stim_channel]
+                    datasets=[sync_frame_channel, sync_stim_channel], 
+                    listdatasets=True, lazy=True)
+            frame_edges = ThorLink.SyncRisingEdges(sync_data[sync_frame_channel], 1)
+            stim_edges = ThorLink.SyncRisingEdges(sync_data[sync_stim_channel], 1)
             rate = 250000
         
         elif sync_ext == '.txt':
@@ -92,28 +95,22 @@ class STAMovieMaker():
         if not error:
             # load movie
             print('Loading movie')
-            movie_ext = os.path.splitext(self.p['moviePath'])[1]
-            if movie_ext == '.bin':
-                movie = PrairieLink.ReadRawFile(self.p['moviePath'])
-            elif movie_ext == '.raw':
-                movie = ThorLink.ReadRawFile(self.p['moviePath'])
-            elif movie_ext == '.tif':
-                movie = tifffile.TiffFile(self.p['moviePath'], multifile=True).asarray()
+            # frames are read from disk as the trial windows need them
+            movie = movie_source.open_movie(self.p['moviePath'])
 
             # get movie dimensions
             num_frames = movie.shape[0]
             frame_dims = movie.shape[1:]
 
             # get frame times
-            frame_times = sta.threshold_detect(
-            frame_trace, 1).astype(np.float) / rate
+            frame_times = frame_edges.astype(np.float) / rate
             frame_times = frame_times[(frame_times > sync_start) & (
             frame_times < sync_stop)]
             frame_times = frame_times[0:num_frames]
             frame_times_all = frame_times
             
             # get stim times
-            all_stim_times = sta.threshold_detect(stim_trace, 1).astype(np.float) / rate
+            all_stim_times = stim_edges.astype(np.float) / rate
             all_stim_times = all_stim_times[(all_stim_times > sync_start) & (all_stim_times < sync_stop)]
             all_stim_times = all_stim_times[(all_stim_times-pre_sec > min(frame_times)) & 
                                             (all_stim_times+post_sec < max(frame_times))]
@@ -180,10 +177,10 @@ class STAMovieMaker():
 
                     # get data
                     trials = np.zeros([len(sta_template), frame_dims[0], frame_dims[1], num_trials], dtype=np.float32)
-                    for j, trial_sta_frames in enumerate(all_trials_sta_frames):
-                        # print(trial_sta_frames)
-                        for k, frame_idx in enumerate(trial_sta_frames):
-                            trials[k, :, :, j] = movie[frame_idx]
+                    # trial windows are read ahead on a thread pool
+                    for j, trial_frames in movie_source.prefetch_windows(
+                            movie, all_trials_sta_frames):
+                        trials[:, :, :, j] = trial_frames
 
                     print(msg + ' - Raw')
 
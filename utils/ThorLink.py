@@ -8,13 +8,16 @@ import numpy as np
 import glob
 import h5py
 
+try:
+	from utils.file_cache import SidecarCache
+	from utils.paq2py import threshold_detect_chunked
+except ModuleNotFoundError:
+	from file_cache import SidecarCache
+	from paq2py import threshold_detect_chunked
+
 # import matplotlib
 # matplotlib.use('TkAgg')
 
-# import sys
-# sys.path.append("tools")
-# from tools import training
-
 # try:
 # 	# for Python2
 # 	import Tkinter as tk
@@ -25,7 +28,7 @@ import h5py
 # 	from tkinter import filedialog
 
 
-def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbose=False, pixels_per_line=512, lines_per_frame=512):
+def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbose=False, pixels_per_line=512, lines_per_frame=512, mmap=False):
 	'''
 	Input
 	-----
@@ -39,11 +42,14 @@ def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbos
 		the total number of frames to read
 	verbose : bool, optional
 		choose whether to display output progress and stats
+	mmap : bool, optional
+		memory-map the requested frames rather than reading them, frames
+		are only loaded from disk when indexed
 
 	Output
 	------
 	data : np.ndarray
-		frames x rows x cols array (dtype=np.uint16)
+		frames x rows x cols array (dtype=np.uint16), np.memmap if mmap
 	'''
 
 	# open file diaog if input not provided
@@ -85,11 +91,14 @@ def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbos
 		# Read data
 		start_on_byte = (((start-1) * samples_per_frame)) *2  # plus 2 because header size, x2 because 1 uint16 is 2 bytes
 		num_chars_to_read = (num_frames * samples_per_frame)  # note size in bytes of char defined by fread function argument
-		f.seek(start_on_byte, 0) 
-		data = np.fromfile(f, dtype=np.int16, count=num_chars_to_read)
+		if mmap:
+			data = np.memmap(movie_path, dtype=np.int16, mode='r', offset=start_on_byte, shape=(num_frames, lines_per_frame, pixels_per_line), order='C')
+		else:
+			f.seek(start_on_byte, 0) 
+			data = np.fromfile(f, dtype=np.int16, count=num_chars_to_read)
 
-	# Reshape data into frame array
-	data = data.reshape(num_frames, lines_per_frame, pixels_per_line, order='C')
+			# Reshape data into frame array
+			data = data.reshape(num_frames, lines_per_frame, pixels_per_line, order='C')
 
 	if verbose:
 		print('Data size: ' + str(data.shape[0]) + ' frames (' + str(data.shape[1]) + ', ' + str(data.shape[2]) + ')')
@@ -101,6 +110,105 @@ def ReadRawFile(movie_path=None, start=1, stop=np.Inf, num_frames=np.Inf, verbos
 	return data
 
 
+def ReadRawGeometry(movie_path, pixels_per_line=512, lines_per_frame=512):
+	# frame geometry from the ThorImage Experiment.xml next to the movie,
+	# the defaults are returned if there is no Experiment.xml
+	xml_path = os.path.join(os.path.dirname(os.path.abspath(movie_path)), 'Experiment.xml')
+	if not os.path.exists(xml_path):
+		return pixels_per_line, lines_per_frame
+
+	import xml.etree.ElementTree as ET
+	lsm = ET.parse(xml_path).getroot().find('.//LSM')
+	if lsm is None:
+		return pixels_per_line, lines_per_frame
+
+	return int(lsm.get('pixelX', pixels_per_line)), int(lsm.get('pixelY', lines_per_frame))
+
+
+class ThorRawMovie():
+	'''
+	An ordered list of Thor *.raw files memory-mapped as one virtual movie
+	indexed by global frame number. Indexing only reads the frames asked
+	for, nothing is concatenated
+
+	Input
+	-----
+	movie_paths : string or list of strings
+		full path(s) to the *.raw file(s) in acquisition order
+	pixels_per_line, lines_per_frame : int, optional
+		frame geometry, read from Experiment.xml (or 512 x 512) if not given
+
+	Attributes
+	----------
+	shape : tuple
+		total frames x rows x cols
+	offsets : np.ndarray
+		global index of the first frame of each file, the last element is
+		the total number of frames
+	'''
+
+	def __init__(self, movie_paths, pixels_per_line=None, lines_per_frame=None):
+		if isinstance(movie_paths, str):
+			movie_paths = [movie_paths]
+		self.movie_paths = list(movie_paths)
+
+		if pixels_per_line is None or lines_per_frame is None:
+			pixels_per_line, lines_per_frame = ReadRawGeometry(self.movie_paths[0])
+		self.pixels_per_line = pixels_per_line
+		self.lines_per_frame = lines_per_frame
+
+		self.movies = [ReadRawFile(movie_path, pixels_per_line=pixels_per_line, lines_per_frame=lines_per_frame, mmap=True) for movie_path in self.movie_paths]
+		self.offsets = np.cumsum([0] + [movie.shape[0] for movie in self.movies])
+		self.shape = (int(self.offsets[-1]), lines_per_frame, pixels_per_line)
+		self.dtype = np.dtype(np.int16)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def FileFrame(self, frame_idx):
+		# global frame index -> (file index, frame index within that file)
+		if frame_idx < 0:
+			frame_idx += self.shape[0]
+		if not 0 <= frame_idx < self.shape[0]:
+			raise IndexError('frame ' + str(frame_idx) + ' out of range')
+		file_idx = int(np.searchsorted(self.offsets, frame_idx, side='right') - 1)
+		return file_idx, frame_idx - self.offsets[file_idx]
+
+	def __getitem__(self, key):
+		if isinstance(key, tuple):
+			# index frames first, then within the frames read
+			frames = self[key[0]]
+			if frames.ndim == 3:
+				return frames[(slice(None),) + key[1:]]
+			return frames[key[1:]]
+
+		if np.ndim(key) == 0 and not isinstance(key, slice):
+			file_idx, frame_idx = self.FileFrame(int(key))
+			return np.array(self.movies[file_idx][frame_idx])
+
+		if isinstance(key, slice):
+			frames = np.arange(*key.indices(self.shape[0]))
+		else:
+			frames = np.asarray(key)
+			frames = np.where(frames < 0, frames + self.shape[0], frames)
+			if np.any((frames < 0) | (frames >= self.shape[0])):
+				raise IndexError('frames out of range')
+
+		data = np.empty((len(frames),) + self.shape[1:], dtype=self.dtype)
+		file_idxs = np.searchsorted(self.offsets, frames, side='right') - 1
+		for file_idx in np.unique(file_idxs):
+			in_file = file_idxs == file_idx
+			data[in_file] = self.movies[file_idx][frames[in_file] - self.offsets[file_idx]]
+
+		return data
+
+	def __array__(self, dtype=None, copy=None):
+		data = self[:]
+		if dtype is not None:
+			data = data.astype(dtype, copy=False)
+		return data
+
+
 def WriteRawFile(data, file_name):
 	# construct filename
 	if not file_name[-4:] == '.raw':
@@ -111,8 +219,184 @@ def WriteRawFile(data, file_name):
 		data.tofile(raw_file)
 
 
-def ReadSyncFile(file_path=None, datasets=None, listdatasets=False):
+class RawFileWriter():
+	'''
+	Writes a Thor *.raw movie a block of frames at a time, so movies larger
+	than memory can be streamed to disk
+
+	Input
+	-----
+	file_name : string
+		path of the *.raw file to write
+	lines_per_frame, pixels_per_line : int, optional
+		frame size
+
+	Use as a context manager or call Close() when done
+	'''
+
+	def __init__(self, file_name, lines_per_frame=512, pixels_per_line=512):
+		if not file_name[-4:] == '.raw':
+			file_name = file_name + '.raw'
+
+		self.file_name = file_name
+		self.frame_shape = (lines_per_frame, pixels_per_line)
+		self.num_frames = 0
+		self.raw_file = open(file_name, 'wb')
+
+	def Write(self, frames):
+		# frames : frames x rows x cols block, or a single frame
+		frames = np.asarray(frames, dtype=np.int16).reshape((-1,) + self.frame_shape)
+		frames.tofile(self.raw_file)
+		self.num_frames += frames.shape[0]
+
+	def Close(self):
+		self.raw_file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.Close()
+
+	# lower case names shared with movie_source.TiffStackWriter
+	write = Write
+	close = Close
+
+
+def ListSyncDatasets(file_path):
+	'''
+	List the datasets in a Thor sync file without reading any data
+
+	Output
+	------
+	info : dict
+		dataset name -> {'path', 'shape', 'dtype', 'chunks'}, chunks is None
+		if the dataset is stored contiguously
+	'''
+
+	info = {}
+	with h5py.File(file_path, 'r') as h5:
+		for group_name in h5:
+			for dataset_name in h5[group_name]:
+				dset = h5[group_name][dataset_name]
+				info[dataset_name] = {'path': group_name + '/' + dataset_name,
+				                      'shape': dset.shape,
+				                      'dtype': dset.dtype,
+				                      'chunks': dset.chunks}
+
+	return info
+
+
+class SyncDataset():
+	'''
+	Lazy proxy of one dataset in a Thor sync file. Nothing is read until the
+	proxy is sliced or iterated, the file is only held open while reading.
+	Use the proxy as a context manager to keep one handle open across many
+	slices, e.g. 'with dset: ...'
+
+	Input
+	-----
+	file_path : string
+		full path to the *.h5 sync file
+	path : string
+		'group/dataset' path of the dataset within the file
+	'''
+
+	def __init__(self, file_path, path):
+		self.file_path = file_path
+		self.path = path
+		self._h5 = None
+		self._depth = 0
+		with h5py.File(file_path, 'r') as h5:
+			dset = h5[path]
+			self.name = dset.name.split('/')[-1]
+			self.shape = dset.shape
+			self.dtype = dset.dtype
+			self.chunks = dset.chunks
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __enter__(self):
+		if self._depth == 0:
+			self._h5 = h5py.File(self.file_path, 'r')
+		self._depth += 1
+		return self
+
+	def __exit__(self, *exc):
+		self._depth -= 1
+		if self._depth == 0:
+			self._h5.close()
+			self._h5 = None
+
+	def __getitem__(self, key):
+		if self._h5 is not None:
+			return self._h5[self.path][key]
+		with self:
+			return self._h5[self.path][key]
+
+	def __array__(self, dtype=None, copy=None):
+		data = self[:]
+		if dtype is not None:
+			data = data.astype(dtype, copy=False)
+		return data
+
+	def BlockSize(self, block_size=2**20):
+		# round block_size down to a whole number of hdf5 chunks so every
+		# chunk is decompressed exactly once
+		if self.chunks is None:
+			return block_size
+		return max(block_size // self.chunks[0], 1) * self.chunks[0]
+
+	def IterBlocks(self, block_size=2**20):
+		'''
+		Yields (start sample, block) over the dataset in chunk-aligned
+		blocks of roughly block_size samples
+		'''
+
+		block_size = self.BlockSize(block_size)
+		with self:
+			dset = self._h5[self.path]
+			for start in range(0, self.shape[0], block_size):
+				yield start, dset[start:start+block_size]
+
+
+def SyncRisingEdges(dataset, threshold=1, block_size=2**20):
+	'''
+	Sample indices at which a sync line crosses above threshold, read in
+	chunk-aligned blocks so memory use is set by block_size rather than the
+	length of the recording (see paq2py.iter_rising_edges). A line that is
+	high on the first sample counts as an edge at sample 0
+
+	Input
+	-----
+	dataset : SyncDataset or np.ndarray
+		the sync line, e.g. from ReadSyncFile(..., lazy=True)
+	threshold : float, optional
+		value above which the line is considered high
+	block_size : int, optional
+		approximate number of samples read at a time
+
+	Output
+	------
+	edges : np.ndarray
+		sample indices of the rising edges (dtype=np.int64)
+	'''
+
+	if isinstance(dataset, SyncDataset):
+		# whole hdf5 chunks per block, so each is decompressed once, read
+		# through one file handle rather than reopening it for every block
+		block_size = dataset.BlockSize(block_size)
+		with dataset:
+			return threshold_detect_chunked(dataset, threshold, block_size)
+
+	return threshold_detect_chunked(dataset, threshold, block_size)
+
+
+def ReadSyncFile(file_path=None, datasets=None, listdatasets=False, lazy=False):
 	# datasets = list of dataset names to load. load all if none provided
+	# lazy = return SyncDataset proxies rather than reading the data, use
+	# SyncRisingEdges or SyncDataset.IterBlocks to process them in blocks
 
 	# open file diaog if input not provided
 	if not file_path:
@@ -128,7 +412,10 @@ def ReadSyncFile(file_path=None, datasets=None, listdatasets=False):
 			for dataset_name in h5[group_name]:
 				dataset_names.append(dataset_name)
 				if datasets == None or dataset_name in datasets:
-					data[dataset_name] = h5[group_name][dataset_name][:]
+					if lazy:
+						data[dataset_name] = SyncDataset(file_path, group_name + '/' + dataset_name)
+					else:
+						data[dataset_name] = h5[group_name][dataset_name][:]
 	
 	if listdatasets:
 		print(dataset_names)
@@ -136,6 +423,138 @@ def ReadSyncFile(file_path=None, datasets=None, listdatasets=False):
 	return data
 
 
+def _CachedVRArrays(file_path, names, parser):
+	# parsed arrays of a VR text file, memory-mapped from a sidecar next to
+	# the file after the first parse. parser returns a tuple of arrays in the
+	# order of names
+	try:
+		cache = SidecarCache(file_path)
+		arrays = [cache.load_array(name + '.npy') for name in names]
+	except OSError:
+		cache, arrays = None, [None]
+
+	if cache is not None and all(arr is not None for arr in arrays):
+		return arrays
+
+	arrays = parser(file_path)
+	if cache is not None:
+		try:
+			for name, arr in zip(names, arrays):
+				cache.save_array(name + '.npy', arr)
+		except OSError as e:
+			print('Could not cache {}: {}'.format(file_path, e))
+
+	return arrays
+
+
+def _ParseColumns(file_path):
+	# whitespace delimited numeric columns, parsed in one pass. a partly
+	# written last row (file still open in the VR) is dropped
+	with open(file_path, 'r') as f:
+		lines = [line for line in f.read().splitlines() if line.strip()]
+
+	if not lines:
+		return (np.zeros((0, 0)),)
+	num_cols = len(lines[0].split())
+
+	# fromstring stops at the first token it cannot parse, so check every
+	# row before the last was read in full
+	values = np.fromstring('\n'.join(lines[:-1]), dtype=np.float64, sep=' ')
+	if len(values) != num_cols * (len(lines) - 1):
+		raise ValueError('{} is not {} whitespace delimited numeric columns, '
+		                 'read {} values from {} rows'.format(
+		                 file_path, num_cols, len(values), len(lines) - 1))
+
+	try:
+		last_row = np.array(lines[-1].split(), dtype=np.float64)
+	except ValueError:
+		last_row = np.zeros(0)
+	if len(last_row) == num_cols:
+		values = np.concatenate([values, last_row])
+
+	return (values.reshape(-1, num_cols),)
+
+
+def _ParseEvents(file_path):
+	# one event per line, time followed by the event text
+	with open(file_path, 'r') as f:
+		lines = [line.split(None, 1) for line in f if line.strip()]
+
+	times = np.array([line[0] for line in lines], dtype=np.float64)
+	labels = np.array([line[1].strip() if len(line) > 1 else '' 
+	                   for line in lines], dtype=np.str_)
+
+	return times, labels
+
+
+def ReadMoveFile(file_path):
+	'''
+	Input
+	-----
+	file_path : string
+		full path to *.move file, whitespace delimited columns of
+		time (ms), mouse 1 x, mouse 1 y, mouse 2 x, mouse 2 y
+
+	Output
+	------
+	vrtimes, m1x, m1y, m2x, m2y : np.ndarray
+		one value per VR frame, memory-mapped from the sidecar cache
+	'''
+
+	data, = _CachedVRArrays(file_path, ['move'], _ParseColumns)
+	return tuple(data[:, col] for col in range(5))
+
+
+def ReadPositionFile(file_path, maxn=None):
+	'''
+	Input
+	-----
+	file_path : string
+		full path to *.position file, whitespace delimited columns of
+		time (ms), x, y, z
+	maxn : int, optional
+		number of VR frames in the move file, the position is cut to match
+
+	Output
+	------
+	posx, posy, posz : np.ndarray
+		one value per VR frame, memory-mapped from the sidecar cache
+	'''
+
+	data, = _CachedVRArrays(file_path, ['position'], _ParseColumns)
+	data = data[:maxn]
+	return data[:, 1], data[:, 2], data[:, 3]
+
+
+def ReadEventsFile(file_path, teleport_times=None):
+	'''
+	Input
+	-----
+	file_path : string
+		full path to *.events file, one event per line as the time (ms)
+		followed by the event text
+	teleport_times : np.ndarray, optional
+		times of teleports detected from the position, merged into the
+		events as 'teleport'
+
+	Output
+	------
+	evlist : np.ndarray
+		event text of each event, sorted by time
+	timeev : np.ndarray
+		time of each event (ms)
+	'''
+
+	timeev, evlist = _CachedVRArrays(file_path, ['events_times', 'events_labels'], _ParseEvents)
+
+	if teleport_times is not None and len(teleport_times):
+		timeev = np.concatenate([timeev, teleport_times])
+		evlist = np.concatenate([evlist, np.full(len(teleport_times), 'teleport')])
+
+	order = np.argsort(timeev, kind='mergesort')
+	return evlist[order], timeev[order]
+
+
 def ReadVRData(folder_path=None):
 	# open file diaog if input not provided
 	if not folder_path:
@@ -145,21 +564,19 @@ def ReadVRData(folder_path=None):
 
 	# read move file
 	move_file_path = glob.glob(os.path.join(folder_path, '*.move'))[0]
-	vrtimes, m1x, m1y, m2x, m2y = training.read_move(move_file_path)
+	vrtimes, m1x, m1y, m2x, m2y = ReadMoveFile(move_file_path)
 	maxn = len(vrtimes)
 
 	# read position file
-	is2d = True
 	position_file_path = glob.glob(os.path.join(folder_path, '*.position'))[0]
-	posx, posy, posz, resets, mdposy = training.read_pos(position_file_path, maxn, is2d)
-	postimes = vrtimes.copy()
+	posx, posy, posz = ReadPositionFile(position_file_path, maxn)
+	postimes = np.array(vrtimes[:len(posy)])
 
-	# read events file
+	# read events file, a teleport is a large backwards jump in y
 	events_file_path = glob.glob(os.path.join(folder_path, '*.events'))[0]
-	teleport_times = ((np.array(vrtimes)))[np.diff(posy) < -0.25]
-	evlist, timeev = training.read_events(events_file_path, teleport_times=teleport_times)
-	# evpos = np.array([maps.get_event_pos(postimes, posx, posy, ev, 0) for ev in evlist])
-	speed = 1.0e3 * np.sqrt(np.gradient(posx)**2+np.gradient(posy)**2)/np.gradient(postimes)
+	teleport_times = postimes[:-1][np.diff(posy) < -0.25]
+	evlist, timeev = ReadEventsFile(events_file_path, teleport_times=teleport_times)
+	speed = 1.0e3 * np.hypot(np.gradient(posx), np.gradient(posy)) / np.gradient(postimes)
 
 	return {'evlist': evlist,
 		'timeev': timeev,
@@ -168,4 +585,3 @@ def ReadVRData(folder_path=None):
 		'posy': posy,
 		'speed': speed
 		}
-
@@ -161,3 +161,118 @@ def artifact_removal(stack, thresh_list='up_to_stim1', remove_me='all', sigma=2,
             stack[frame_idx, :, :] = processed_frame
 
         return stack
+
+
+def stream_threshold(source, frames, sigma, block_size=500):
+
+    '''
+    find_threshold of frames of source without holding them all in memory,
+    the baseline mean and std are accumulated a block of frames at a time
+    '''
+
+    frames = np.sort(np.asarray(frames, dtype=np.int64))
+    if frames.size == 0:
+        raise ValueError('no baseline frames to find the threshold from')
+
+    n = 0
+    mean = None
+    m2 = None
+    for start in range(0, len(frames), block_size):
+        idx = frames[start:start+block_size]
+        if hasattr(source, 'get_frames'):
+            block = source.get_frames(idx)
+        else:
+            block = source[idx]
+        block = np.asarray(block, dtype=np.float64)
+
+        # merge the block's mean and sum of squared deviations into the
+        # running ones (Chan et al.), stable where sum of squares is not
+        block_mean = block.mean(0)
+        block_m2 = ((block - block_mean)**2).sum(0)
+        if mean is None:
+            mean, m2 = block_mean, block_m2
+        else:
+            delta = block_mean - mean
+            total = n + len(idx)
+            mean = mean + delta * len(idx) / total
+            m2 = m2 + block_m2 + delta**2 * n * len(idx) / total
+        n += len(idx)
+
+    return mean + np.sqrt(m2 / n)*sigma
+
+
+def artifact_removal_stream(source, writer, thresh_list, remove_me, sigma=2, 
+                            width_thresh=10, nplanes=1, block_size=500):
+
+    '''
+    artifact removal for stacks larger than memory, frames are read from
+    source and written to writer a block at a time
+    --------
+    inputs
+    --------
+    source: frames x rows x cols stack that can be sliced without loading
+            all of it, e.g. a memmap or movie_source.MovieSource
+    writer: object with a write(frames) method e.g. from
+            movie_source.open_writer, every frame of source is written to it
+    thresh_list: frames to average to get baseline pixel values
+    remove_me: frames to run artifact removal algorithm on
+    sigma: sigma value of pixel intensity disribution above to mark as potentially contaminated
+    width_thresh: groups of connected pixels with width less than this value will be removed
+    nplanes: number of interleaved planes, each plane gets its own threshold
+             from the frames of thresh_list in that plane. thresh_list holds
+             frame indices of source, unlike artifact_removal which indexes
+             the frames of each plane with them
+    block_size: number of frames held in memory at a time
+    '''
+
+    n_frames = source.shape[0]
+    thresh_list = np.asarray(thresh_list)
+    remove_me = set(int(f) for f in remove_me)
+
+    # baseline threshold of each plane, only the baseline frames are read
+    threshs = []
+    for i in range(nplanes):
+        plane_frames = thresh_list[thresh_list % nplanes == i]
+        if plane_frames.size == 0:
+            raise ValueError('no baseline frames in thresh_list for plane '
+                             '{} of {}'.format(i, nplanes))
+        threshs.append(stream_threshold(source, plane_frames, sigma,
+                                        block_size))
+
+    for start in range(0, n_frames, block_size):
+        block = np.array(source[start:start+block_size])
+
+        for j in range(block.shape[0]):
+            frame_idx = start + j
+            if frame_idx not in remove_me:
+                continue
+
+            thresh = threshs[frame_idx % nplanes]
+            frame_bin = binarise_frame(block[j], thresh)
+            block[j] = process_frame(block[j], frame_bin, width_thresh)
+
+        writer.write(block)
+
+
+def find_artifact_frames(frame_stats, baseline_frames, sigma=5, field='crop_max'):
+
+    '''
+    finds frames likely to contain photostim artifact from per-frame
+    statistics (movie_source.movie_frame_stats) without reading the movie
+    --------
+    inputs
+    --------
+    frame_stats: structured array of per-frame statistics
+    baseline_frames: frames known to be free of artifact
+    sigma: frames more than sigma baseline std above the baseline mean are marked
+    field: statistic to threshold, the max of the central crop by default
+    --------
+    returns
+    frames: indices of frames marked as containing artifact
+    '''
+
+    values = np.asarray(frame_stats[field], dtype=float)
+    base_vals = values[np.asarray(baseline_frames)]
+    thresh = base_vals.mean() + base_vals.std()*sigma
+
+    return np.where(values > thresh)[0]
@@ -10,6 +10,8 @@ from suite2p.run_s2p import run_s2p
 from my_suite2p.settings import ops
 import utils_funcs as utils
 import run_functions as rf
+from tiff_convert import consolidate_tseries, consolidation_verified
+from tiff_info import tiff_metadata, tiffs_metadata
 import re
 import tifffile
 import glob
@@ -61,29 +63,6 @@ def run_processor(mouse_id, run_number, pkl_path,
 
         return None
         
-def tiff_metadata(tiff_folder):
-
-    ''' takes input of list of tiff folders and returns 
-        number of frames in the first of each tiff folder '''
-
-    with tifffile.TiffFile(tiff_folder) as tif:
-        tif_tags = {}
-        for tag in tif.pages[0].tags.values():
-            name, value = tag.name, tag.value
-            tif_tags[name] = value
-
-    x_px = tif_tags['ImageWidth']
-    y_px = tif_tags['ImageLength']
-    image_dims = [x_px, y_px]
-
-    n_frames = re.search('(?<=\[)(.*?)(?=\,)', 
-                         tif_tags['ImageDescription'])
-
-    n_frames = int(n_frames.group(0))
-
-    return image_dims, n_frames
-
-
 def preprocess_flu(run):
 
     ''' Function to load the fluoresence matrix from suite2p output,
@@ -232,6 +211,7 @@ def main(mouse_id, run_number, pkl_path,
     
     print('\nfollowing tseries found:')
     tiff_list = []
+    first_tiffs = []
     print(run.tseries_paths)
     for tseries in run.tseries_paths:
         tiffs = utils.get_tiffs(tseries)
@@ -261,8 +241,22 @@ def main(mouse_id, run_number, pkl_path,
             multipages.sort()
 
             if not multipages:
-                raise ValueError('Folder likely contains unconverted single '
-                                 'page tiffs')
+                # unconverted single page tiffs, consolidate the green 
+                # channel and delete the originals once verified
+                print('Folder contains unconverted single page tiffs, '
+                      'consolidating')
+                multipages = [consolidate_tseries(tseries, channel='Ch3',
+                                                  delete=True)]
+            else:
+                # a consolidation whose delete of the originals was
+                # interrupted, finish it (each original is checked against
+                # its frame of the output first)
+                for multipage in multipages:
+                    if multipage.endswith('Ch3.tif') and \
+                       consolidation_verified(multipage):
+                        consolidate_tseries(tseries, channel='Ch3',
+                                            output_path=multipage,
+                                            delete=True)
 
             # check that the number of tiffs in the multipage matches the 
             # number of .ome
@@ -287,7 +281,10 @@ def main(mouse_id, run_number, pkl_path,
                 tiff_list.append(multipages[0])
                 tiffs = [multipages[0]]
 
-        image_dims, n_frames = tiff_metadata(tiffs[0])
+        first_tiffs.append(tiffs[0])
+
+    # only the needed tags are read, all tseries at once and cached locally
+    for image_dims, n_frames in tiffs_metadata(first_tiffs):
         tseries_dims.append(image_dims)
         tseries_nframes.append(n_frames)
 
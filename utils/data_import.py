@@ -226,8 +226,58 @@ def _toDate(d): # Convert input to datetime.date object.
 # Load analog data
 #----------------------------------------------------------------------------------
 
-def load_analog_data(file_path):
+def load_analog_data(file_path, mmap=False):
     '''Load a pyControl analog data file and return the contents as a numpy array
-    whose first column is timestamps (ms) and second data values.'''
+    whose first column is timestamps (ms) and second data values. If mmap is True
+    the file is memory-mapped rather than read, so only the parts used are loaded.'''
+    if mmap:
+        n_samples = os.path.getsize(file_path) // 8
+        if n_samples == 0:
+            return np.zeros((0,2), dtype='<i')
+        return np.memmap(file_path, dtype='<i', mode='r', shape=(n_samples,2))
     with open(file_path, 'rb') as f:
         return np.fromfile(f, dtype='<i').reshape(-1,2)
+
+def resample_analog(analog_data, frame_times, method='mean', chunk_size=2**20):
+    '''Resample pyControl analog data onto imaging frame times, e.g. frame clock
+    times mapped to pyControl time with Rsync_aligner.B_to_A. With method 'mean'
+    each frame gets the mean of the samples from its time up to the next frame's
+    time (the last frame covers one median frame interval), with method 'interp'
+    the signal is linearly interpolated at each frame time. Frames with no
+    samples, outside the recording, or with nan times are nan. The analog data
+    is read chunk_size samples at a time, so it can be a memory-map of a long
+    recording from load_analog_data(file_path, mmap=True).'''
+    frame_times = np.asarray(frame_times, dtype=float)
+    resampled = np.full(len(frame_times), np.nan)
+    valid = ~np.isnan(frame_times)
+    times = frame_times[valid]
+    if len(times) == 0 or len(analog_data) == 0:
+        return resampled
+    assert np.all(np.diff(times) > 0), 'frame_times must be increasing.'
+    n_samples = len(analog_data)
+    if method == 'mean':
+        interval = np.median(np.diff(times)) if len(times) > 1 else np.inf
+        edges = np.append(times, times[-1] + interval)
+        sums = np.zeros(len(times))
+        counts = np.zeros(len(times))
+        for start in range(0, n_samples, chunk_size):
+            chunk = np.asarray(analog_data[start:start+chunk_size])
+            bins = np.searchsorted(edges, chunk[:,0], side='right') - 1
+            in_frame = (bins >= 0) & (bins < len(times))
+            sums += np.bincount(bins[in_frame], weights=chunk[in_frame,1],
+                                minlength=len(times))
+            counts += np.bincount(bins[in_frame], minlength=len(times))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = sums / counts
+    elif method == 'interp':
+        values = np.full(len(times), np.nan)
+        for start in range(0, n_samples, chunk_size):
+            # overlap chunks by one sample so frames between chunks are covered.
+            chunk = np.asarray(analog_data[start:start+chunk_size+1])
+            first, last = np.searchsorted(times, [chunk[0,0], chunk[-1,0]], side='left')
+            if chunk[-1,0] in times[last:last+1]: last += 1
+            values[first:last] = np.interp(times[first:last], chunk[:,0], chunk[:,1])
+    else:
+        raise ValueError("method must be 'mean' or 'interp'.")
+    resampled[valid] = values
+    return resampled
@@ -0,0 +1,125 @@
+'''
+Sidecar caches for data derived from large acquisition files
+
+A sidecar is a folder next to the source file (e.g. run.paq -> run.paq.vape)
+holding derived arrays and json. The folder carries a manifest with the
+fingerprint (size, mtime) of the source, any change to the source invalidates
+everything in the sidecar.
+'''
+
+import os
+import json
+import shutil
+import numpy as np
+
+
+def file_fingerprint(file_path):
+    '''returns [size in bytes, mtime in ns] of file_path, changes whenever
+       the file is rewritten without having to read its contents'''
+
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class SidecarCache():
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, file_path, suffix='.vape'):
+        '''
+        Cache of arrays and json derived from file_path
+
+        Inputs:
+        file_path -- the source file the cached data was derived from
+        suffix    -- appended to file_path to name the sidecar folder
+
+        Nothing is written until the first save, so instantiating
+        a SidecarCache for a file on a read-only mount is harmless
+        '''
+
+        self.file_path = file_path
+        self.cache_dir = file_path + suffix
+        self.fingerprint = file_fingerprint(file_path)
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    @property
+    def is_valid(self):
+        '''True if the sidecar exists and was built from the current file'''
+        try:
+            with open(self.path(self.manifest_name), 'r') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        return manifest.get('fingerprint') == self.fingerprint
+
+    def has(self, name):
+        return self.is_valid and os.path.exists(self.path(name))
+
+    def _prepare(self):
+        '''make the sidecar folder, clearing it if it is stale'''
+
+        if self.is_valid:
+            return
+
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        os.makedirs(self.cache_dir)
+
+        self._write_json(self.manifest_name,
+                         {'source': os.path.basename(self.file_path),
+                          'fingerprint': self.fingerprint})
+
+    def _write_json(self, name, obj):
+        tmp_path = self.path(name) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, self.path(name))
+
+    def load_json(self, name):
+        '''returns the cached json object name or None if not cached'''
+        if not self.has(name):
+            return None
+        with open(self.path(name), 'r') as f:
+            return json.load(f)
+
+    def save_json(self, name, obj):
+        self._prepare()
+        self._write_json(name, obj)
+
+    def load_array(self, name, mmap_mode='r'):
+        '''returns the cached .npy array name (memory-mapped by default)
+           or None if not cached'''
+        if not self.has(name):
+            return None
+        return np.load(self.path(name), mmap_mode=mmap_mode)
+
+    def save_array(self, name, arr):
+        self._prepare()
+        tmp_path = self.path(name) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp_path, self.path(name))
+
+    def create_array(self, name, shape, dtype):
+        '''
+        Returns a writeable memmap of a new .npy array name for filling in
+        chunks. The array is not visible to load_array until commit(name)
+        is called, so a half-written array is never read back
+        '''
+        self._prepare()
+        return np.lib.format.open_memmap(self.path(name) + '.tmp', mode='w+',
+                                         shape=shape, dtype=dtype)
+
+    def commit(self, name):
+        os.replace(self.path(name) + '.tmp', self.path(name))
+
+
+def cache_root():
+    '''local folder for caches of data on network storage, $VAPE_CACHE
+       or ~/.vape_cache'''
+    return os.environ.get('VAPE_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.vape_cache'))
+
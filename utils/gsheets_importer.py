@@ -113,7 +113,7 @@ def correct_behaviour_df(df, t_series_header='t-series name'):
     '''
     inputs the Optimstim Behaviour Metadata
     corrects blank rows that have been merged in gsheets and converts
-    lists of t series names from newlines to python lists
+    lists of t series names and paq files from newlines to python lists
 
     '''
     # fix blank merged rows
@@ -130,7 +130,9 @@ def correct_behaviour_df(df, t_series_header='t-series name'):
             df = df.drop(row, axis=0)
 
     # fix newline lists
-    for column_header in [t_series_header, 't-series name']:
+    for column_header in [t_series_header, 't-series name', '.paq file']:
+        if column_header not in df:
+            continue
         for row, val in enumerate(df[column_header]):
 
             if '\n' in val:
@@ -10,6 +10,11 @@ import bisect
 import copy
 import pickle
 
+try:
+    from utils.movie_source import open_movie, prefetch_windows, Suite2pBinMovie, movie_frame_stats
+except ModuleNotFoundError:
+    from movie_source import open_movie, prefetch_windows, Suite2pBinMovie, movie_frame_stats
+
 # global plotting params
 params = {'legend.fontsize': 'x-large',
           'axes.labelsize': 'x-large',
@@ -54,14 +59,16 @@ def points_in_circle_np(radius, x0=0, y0=0, ):
         yield x, y
 
         
-def staMovie(output_dir, pkl_list=False):
+def staMovie(output_dir, pkl_list=False, use_s2p=False):
     '''Function to construct stimulus-triggered average (STA) movie
-    Uses tifffile exclusively and takes up a lot of RAM
+    Trial windows are read from the tiff with a MovieSource
     Consider using STAMovieMaker without a GUI
     
     Inputs:
         output_dir -- directory to save movie to
         pkl_list   -- list of pickled objects to obtain metadata for STA movie
+        use_s2p    -- read the motion corrected frames of each experiment from
+                      the suite2p registered binary rather than the raw tiff
     '''
     
     plane = 0
@@ -88,24 +95,35 @@ def staMovie(output_dir, pkl_list=False):
             size_x = exp_obj.frame_x
             size_z = (exp_obj.pre_frames*2) + int(exp_obj.stim_dur/exp_obj.fps)
                 
-            trial_stack = np.empty([0, size_z, size_y, size_x])
+            trial_sum = np.zeros([size_z, size_y, size_x])
+            n_trials = 0
                 
             for file in os.listdir(exp_obj.tiff_path):
                 if '.tif' in file:
                     tiff_file = os.path.join(exp_obj.tiff_path, file)
                     break
+            
+            if use_s2p:
+                # frames of this experiment within the concatenated binary
+                movie = Suite2pBinMovie(exp_obj.s2p_path).subset(exp_obj.frames)
+            else:
+                movie = open_movie(tiff_file)
                 
+            windows = []
             for t in range(exp_obj.n_trials):
                 frame_start = exp_obj.stim_start_frames[plane][t]
                 trial_start = frame_start - exp_obj.pre_frames
                 trial_end = frame_start + exp_obj.pre_frames + int(exp_obj.stim_dur/exp_obj.fps)
 
                 if trial_end <= exp_obj.n_frames: # for if the tiff file is incomplete (due to corrupt data)
-                    trial = tf.imread(tiff_file, key=range(trial_start, trial_end))
-                    trial = np.expand_dims(trial,axis=0)
-                    trial_stack = np.append(trial_stack, trial, axis=0)
+                    windows.append(range(trial_start, trial_end))
+            
+            # trials are read ahead on a thread pool while earlier ones are summed
+            for t, trial in prefetch_windows(movie, windows):
+                trial_sum += trial
+                n_trials += 1
                         
-            trial_avg = np.mean(trial_stack, axis=0)
+            trial_avg = trial_sum / n_trials
             avg_baseline = trial_avg[: exp_obj.pre_frames, :, :]
             baseline_mean = np.mean(avg_baseline, 0)
 
@@ -116,7 +134,7 @@ def staMovie(output_dir, pkl_list=False):
             output_path = os.path.join(output_dir, file + '_plane' + str(plane) + '.tif')
 
             tf.imwrite(output_path, dff_stack)
-            print('STA movie made for', np.shape(trial_stack)[0], 'trials:', output_path)
+            print('STA movie made for', n_trials, 'trials:', output_path)
             
     
 def cellFluTime(pkl_list, trial_types='pr ps w none', cell_type=False):
@@ -196,18 +214,21 @@ def frameFluTime(data_folder, legend=False):
     fig, ax = plt.subplots(nrows=2, ncols=1, figsize=(15,10), sharex=True)
     labels = []
 
-    for _, _, files in os.walk(data_folder):
-        for file in files:
-            file_path = os.path.join(data_folder,file)
+    # only the tiffs at the top level, not the .vape sidecars next to them
+    for file in sorted(os.listdir(data_folder)):
+        file_path = os.path.join(data_folder,file)
+        if not file.endswith(('.tif', '.tiff')) or not os.path.isfile(file_path):
+            continue
 
-            tiff = tf.imread(file_path)
+        # per-frame means are computed once and cached next to the tiff
+        frame_means = movie_frame_stats(file_path)['mean']
 
-            raw_f_drift = np.mean(tiff, axis=(1,2)) - (2**16/2)
-            norm_f_drift = raw_f_drift/raw_f_drift[0]
+        raw_f_drift = frame_means - (2**16/2)
+        norm_f_drift = raw_f_drift/raw_f_drift[0]
 
-            ax[0].plot(raw_f_drift)
-            ax[1].plot(norm_f_drift)
-            labels.append(file)
+        ax[0].plot(raw_f_drift)
+        ax[1].plot(norm_f_drift)
+        labels.append(file)
 
     plt.xlabel('experiments');
     plt.xticks(range(0,8), np.tile(np.array(['start','end']), 4));
@@ -255,8 +276,9 @@ def downsampleTiff(pkl_list, save_path):
             start_frames = total_frames[:1000] 
             end_frames = total_frames[-1000:] 
             
-            stack_start = tf.imread(tiff_file, key=start_frames)
-            stack_end = tf.imread(tiff_file, key=end_frames)
+            movie = open_movie(tiff_file)
+            stack_start = movie.get_frames(start_frames)
+            stack_end = movie.get_frames(end_frames)
             
             mean_start = np.mean(stack_start, axis=0)
             mean_end = np.mean(stack_end, axis=0)
@@ -22,6 +22,7 @@ import statsmodels.stats as smstats
 from utils.gsheets_importer import gsheet2df, split_df, path_conversion, path_finder
 from utils.paq2py import *
 from utils.utils_funcs import *
+from utils.parse_metadata import PVStateShard, readPVxml, readNAPARMxmls, readNAPARMgpls
 
 import xml.etree.ElementTree as ET
 
@@ -402,43 +403,14 @@ class interarealAnalysis():
         Find the value, description and indices of a particular parameter from an xml file
         
         Inputs:
-            path        - path to xml file
+            root        - xml element holding the PVStateShard (root or a Frame)
             key         - string corresponding to key in xml tree
         Outputs:
             value       - value of the key
             description - unused
             index       - index that the key was found at
         '''
-        value = []
-        description = []
-        index = []
-
-        pv_state_shard = root.find('PVStateShard') # find pv state shard element in root
-    
-        for elem in pv_state_shard: # for each element in pv state shard, find the value for the specified key
-            if elem.get('key') == key: 
-                if len(elem) == 0: # if the element has only one subelement
-                    value = elem.get('value')
-                    break
-
-                else: # if the element has many subelements (i.e. lots of entries for that key)
-                    for subelem in elem:
-                        value.append(subelem.get('value'))
-                        description.append(subelem.get('description'))
-                        index.append(subelem.get('index'))
-            else:
-                for subelem in elem: # if key not in element, try subelements
-                    if subelem.get('key') == key:
-                        value = elem.get('value')
-                        break
-
-            if value: # if found key in subelement, break the loop
-                break
-
-        if not value: # if no value found at all, raise exception
-            raise Exception('ERROR: no element or subelement with that key')
-
-        return value, description, index
+        return PVStateShard.from_element(root).get(key)
 
     
     def _parsePVMetadata(self):
@@ -460,34 +432,30 @@ class interarealAnalysis():
         except:
             raise Exception('ERROR: Could not find xml for this acquisition, check it exists')
 
-        xml_tree = ET.parse(xml_path) # parse xml from a path
-        root = xml_tree.getroot() # make xml tree structure
-
-        sequence = root.find('Sequence')
-        acq_type = sequence.get('type')
+        meta = readPVxml(xml_path) # from the metadata store unless the xml has changed
+        shard = meta['shard']
 
-        if 'ZSeries' in acq_type:
-            n_planes = len(sequence.findall('Frame'))
+        if 'ZSeries' in meta['acq_type']:
+            n_planes = meta['n_seq_frames']
         else:
             n_planes = 1
         
-        frame_branch = root.findall('Sequence/Frame')[-1]
-#         frame_period = float(self._getPVStateShard(root,'framePeriod')[0])
-        frame_period = float(self._getPVStateShard(frame_branch, 'framePeriod')[0])
+#         frame_period = float(shard.get('framePeriod')[0])
+        frame_period = float(meta['last_frame_shard'].get('framePeriod')[0])
         fps = 1/frame_period
         
-        frame_x = int(self._getPVStateShard(root,'pixelsPerLine')[0])
-        frame_y = int(self._getPVStateShard(root,'linesPerFrame')[0])
-        zoom = float(self._getPVStateShard(root,'opticalZoom')[0])
+        frame_x = int(shard.get('pixelsPerLine')[0])
+        frame_y = int(shard.get('linesPerFrame')[0])
+        zoom = float(shard.get('opticalZoom')[0])
 
-        scan_volts, _, index = self._getPVStateShard(root,'currentScanCenter')
+        scan_volts, _, index = shard.get('currentScanCenter')
         for scan_volts,index in zip(scan_volts,index):
             if index == 'XAxis':
                 scan_x = float(scan_volts)
             if index == 'YAxis':
                 scan_y = float(scan_volts)
 
-        pixel_size, _, index = self._getPVStateShard(root,'micronsPerPixel')
+        pixel_size, _, index = shard.get('micronsPerPixel')
         for pixel_size,index in zip(pixel_size,index):
             if index == 'XAxis':
                 pix_sz_x = float(pixel_size)
@@ -495,12 +463,11 @@ class interarealAnalysis():
                 pix_sz_y = float(pixel_size)
         
         if n_planes == 1:
-            n_frames = root.findall('Sequence/Frame')[-1].get('index') # use suite2p output instead later
+            n_frames = meta['last_frame_index'] # use suite2p output instead later
         else: 
-            n_frames = root.findall('Sequence')[-1].get('cycle')
+            n_frames = meta['last_cycle']
     
-        extra_params = root.find('Sequence/Frame/ExtraParameters')
-        last_good_frame = extra_params.get('lastGoodFrame')
+        last_good_frame = meta['last_good_frame']
 
         self.fps = fps/n_planes
         self.frame_x = frame_x
@@ -532,16 +499,15 @@ class interarealAnalysis():
         NAPARM_xml_path = path_finder(self.naparm_path, '.xml')[0];
         print('\nNAPARM xml:', NAPARM_xml_path)
 
-        xml_tree = ET.parse(NAPARM_xml_path)
-        root = xml_tree.getroot()
+        naparm = readNAPARMxmls([NAPARM_xml_path])[0] # from the metadata store
 
-        title = root.get('Name')
-        n_trials = int(root.get('Iterations'))
+        title = naparm['name']
+        n_trials = int(naparm['iterations'])
 
-        for elem in root:
-            if int(elem[0].get('InitialDelay')) > 0:
-                inter_point_delay = int(elem[0].get('InitialDelay'))
-                single_stim_dur = float(elem[0].get('Duration'))
+        for point in naparm['first_points']:
+            if int(point.get('InitialDelay')) > 0:
+                inter_point_delay = int(point.get('InitialDelay'))
+                single_stim_dur = float(point.get('Duration'))
 
         n_groups, n_reps, n_shots = [int(s) for s in re.findall(r'\d+', title)] 
         
@@ -567,13 +533,12 @@ class interarealAnalysis():
         NAPARM_gpl_path = path_finder(self.naparm_path, '.gpl')[0];
         print('\nNAPARM gpl:', NAPARM_gpl_path)
 
-        xml_tree = ET.parse(NAPARM_gpl_path)
-        root = xml_tree.getroot()
+        points = readNAPARMgpls([NAPARM_gpl_path])[0] # from the metadata store
 
-        for elem in root:
-            if elem.get('Duration'):
-#                 single_stim_dur = float(elem.get('Duration'))
-                spiral_size = float(elem.get('SpiralSize'))
+        for point in points:
+            if point.get('Duration'):
+#                 single_stim_dur = float(point.get('Duration'))
+                spiral_size = float(point.get('SpiralSize'))
                 spiral_size = (spiral_size + 0.005155) / 0.005269
                 break
         
@@ -591,9 +556,10 @@ class interarealAnalysis():
         '''
         print('\nFinding stim frames from:', self.paq_path)
         
-        paq_file = paq_read(self.paq_path)
-        self.frame_clock = paq_data(paq_file, 'frame_clock', threshold_ttl=True, plot=False) 
-        self.stim_times = paq_data(paq_file, self.stim_channel, threshold_ttl=True, plot=False)
+        paq_file = PaqFile(self.paq_path, make_sidecar=True)
+        edges = paq_digital_edges(paq_file, ['frame_clock', self.stim_channel])
+        self.frame_clock = edges['frame_clock']
+        self.stim_times = edges[self.stim_channel]
 
         self.stim_start_frames = []
         
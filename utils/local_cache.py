@@ -0,0 +1,305 @@
+'''
+Read-through cache of NAS files on a local disk
+
+Files under the qnap Data folder are copied onto local scratch (by default
+a vape_cache folder on suite2p's fast_disk) the first time they are staged,
+and path resolution then returns the local copy for as long as the remote
+file is unchanged. Copies are checksummed as they are made and the least
+recently used ones are evicted to keep the cache under a size budget.
+
+Environment variables:
+VAPE_LOCAL_CACHE    -- cache folder, overrides fast_disk
+VAPE_LOCAL_CACHE_GB -- size budget in GB (default 200)
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no flock on windows, only threads of one process are kept in step
+    fcntl = None
+
+try:
+    from utils.file_cache import file_fingerprint, cache_root
+except ModuleNotFoundError:
+    from file_cache import file_fingerprint, cache_root
+
+# qnap Data folder, also BlimpImport.server_path
+SERVER_PATH = '/home/jrowland/mnt/qnap/Data'
+INDEX_NAME = 'index.json'
+LOCK_NAME = 'index.lock'
+# suffix of the file_cache.SidecarCache folders made next to cached copies
+SIDECAR_SUFFIX = '.vape'
+
+
+def default_root():
+    '''VAPE_LOCAL_CACHE, else vape_cache on suite2p's fast_disk, else the
+       local cache root'''
+
+    if 'VAPE_LOCAL_CACHE' in os.environ:
+        return os.environ['VAPE_LOCAL_CACHE']
+    try:
+        from my_suite2p.settings import ops
+        return os.path.join(ops['fast_disk'], 'vape_cache')
+    except (ImportError, KeyError):
+        return os.path.join(cache_root(), 'local')
+
+
+def file_checksum(file_path, chunk_size=2**23):
+    '''sha1 of file_path, read chunk_size bytes at a time'''
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _copy_checksum(src_path, dst_path, chunk_size=2**23):
+    '''copies src_path to dst_path chunk_size bytes at a time and returns
+       the sha1 of what was read, so the source is only read once'''
+    sha1 = hashlib.sha1()
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        for chunk in iter(lambda: src.read(chunk_size), b''):
+            sha1.update(chunk)
+            dst.write(chunk)
+    return sha1.hexdigest()
+
+
+def _folder_size(folder):
+    '''total size in bytes of the files in folder, 0 if it does not exist'''
+    size = 0
+    for dirpath, _, files in os.walk(folder):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, file))
+            except OSError:
+                pass
+    return size
+
+
+class LocalStore():
+
+    def __init__(self, root=None, budget_gb=None, remote_root=SERVER_PATH):
+        '''
+        Local copies of remote files with LRU eviction
+
+        Inputs:
+        root        -- local cache folder (default_root() if None)
+        budget_gb   -- maximum size in GB of the cached copies and the
+                       sidecars made next to them
+        remote_root -- remote folder whose layout is mirrored under root,
+                       files outside it are stored by a hash of their path
+        '''
+
+        self.root = root if root is not None else default_root()
+        if budget_gb is None:
+            budget_gb = float(os.environ.get('VAPE_LOCAL_CACHE_GB', 200))
+        self.budget_bytes = int(budget_gb * 2**30)
+        self.remote_root = os.path.normpath(remote_root)
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.root, INDEX_NAME)
+
+    @contextmanager
+    def _index_lock(self):
+        '''
+        Held around every read-modify-write of the index and eviction. The
+        cache folder is shared by every process using it (e.g. parallel
+        cacher runs), so the threading lock is backed by flock on a lock
+        file in the root
+        '''
+
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, LOCK_NAME), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def local_path(self, remote_path):
+        '''where the local copy of remote_path is (or would be) stored'''
+
+        remote_path = os.path.normpath(os.path.abspath(remote_path))
+        if remote_path.startswith(self.remote_root + os.sep):
+            rel_path = os.path.relpath(remote_path, self.remote_root)
+            return os.path.join(self.root, 'Data', rel_path)
+
+        key = hashlib.sha1(remote_path.encode()).hexdigest()
+        return os.path.join(self.root, 'other', key,
+                            os.path.basename(remote_path))
+
+    def _valid_entry(self, index, remote_path):
+        '''index entry of remote_path if its local copy is still good'''
+
+        entry = index.get(os.path.abspath(remote_path))
+        if entry is None:
+            return None
+
+        try:
+            fingerprint = file_fingerprint(remote_path)
+        except OSError:
+            # remote unreachable, trust the local copy
+            fingerprint = entry['fingerprint']
+
+        local_path = entry['local_path']
+        if fingerprint != entry['fingerprint'] or \
+           not os.path.exists(local_path) or \
+           os.path.getsize(local_path) != entry['fingerprint'][0]:
+            return None
+
+        return entry
+
+    def resolve(self, path):
+        '''
+        Returns the local copy of path if one is cached and the remote file
+        has not changed since, otherwise path. Nothing is copied
+        '''
+
+        if not os.path.isfile(path) and \
+           os.path.abspath(path) not in self._load_index():
+            return path
+
+        with self._index_lock():
+            index = self._load_index()
+            entry = self._valid_entry(index, path)
+            if entry is None:
+                return path
+            entry['last_used'] = time.time()
+            self._save_index(index)
+
+        return entry['local_path']
+
+    def fetch(self, remote_path, verify=False):
+        '''
+        Returns a local copy of remote_path, copying it into the cache if it
+        is not there or has changed. The copy is checksummed against the
+        remote file before it is used
+
+        Inputs:
+        remote_path -- file to stage
+        verify      -- re-checksum an existing local copy before using it
+        '''
+
+        with self._index_lock():
+            index = self._load_index()
+            entry = self._valid_entry(index, remote_path)
+
+        if entry is not None and verify and \
+           file_checksum(entry['local_path']) != entry['sha1']:
+            entry = None
+
+        if entry is None:
+            entry = self._copy(remote_path)
+
+        with self._index_lock():
+            index = self._load_index()
+            entry['last_used'] = time.time()
+            index[os.path.abspath(remote_path)] = entry
+            self._evict(index, keep=entry['local_path'])
+            self._save_index(index)
+
+        return entry['local_path']
+
+    def _copy(self, remote_path):
+        '''copies remote_path into the cache and checks the copy'''
+
+        local_path = self.local_path(remote_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(local_path, os.getpid())
+
+        fingerprint = file_fingerprint(remote_path)
+        print('Staging {} to local cache'.format(remote_path))
+        sha1 = _copy_checksum(remote_path, tmp_path)
+
+        # the remote file is read once, only the local copy is read back
+        if file_checksum(tmp_path) != sha1 or \
+           file_fingerprint(remote_path) != fingerprint:
+            os.remove(tmp_path)
+            raise IOError('local copy of {} does not match the remote file'
+                          .format(remote_path))
+
+        os.replace(tmp_path, local_path)
+
+        return {'local_path': local_path,
+                'fingerprint': fingerprint,
+                'sha1': sha1}
+
+    def _evict(self, index, keep=None):
+        '''removes least recently used copies, and the sidecars made next to
+           them, until under budget'''
+
+        sizes = {remote_path: entry['fingerprint'][0] +
+                 _folder_size(entry['local_path'] + SIDECAR_SUFFIX)
+                 for remote_path, entry in index.items()}
+        total = sum(sizes.values())
+        by_age = sorted(index.items(), key=lambda item: item[1]['last_used'])
+
+        for remote_path, entry in by_age:
+            if total <= self.budget_bytes:
+                break
+            if entry['local_path'] == keep:
+                continue
+            try:
+                os.remove(entry['local_path'])
+            except OSError:
+                pass
+            shutil.rmtree(entry['local_path'] + SIDECAR_SUFFIX,
+                          ignore_errors=True)
+            total -= sizes[remote_path]
+            del index[remote_path]
+
+
+_store = None
+
+
+def default_store():
+    '''the LocalStore shared by the analysis code'''
+    global _store
+    if _store is None:
+        _store = LocalStore()
+    return _store
+
+
+def local_path(path, stage=False):
+    '''
+    Path to read path from, the local copy if it is cached. If stage is
+    True a file that is not cached yet is copied in first. Falls back to
+    path if the cache cannot be used (e.g. the local disk is full)
+    '''
+
+    store = default_store()
+    try:
+        if stage and os.path.isfile(path):
+            return store.fetch(path)
+        return store.resolve(path)
+    except OSError as e:
+        print('Local cache not used for {}: {}'.format(path, e))
+        return path
@@ -0,0 +1,216 @@
+'''
+Local SQLite store of acquisition metadata parsed from files on the NAS
+
+Parsed PrairieView xml, NAPARM xml/gpl and tiff metadata are kept as json in
+a single database under the local cache root ($VAPE_CACHE or ~/.vape_cache),
+one row per (kind, path). A row is only used while the file keeps the size
+and mtime it had when it was parsed, so building a session object only
+stats its files and re-parses the ones that have changed. get_many and
+lookup_many fetch the rows of many files with one query, and entries lists
+everything cached of a kind for queries across sessions without touching
+the NAS at all.
+'''
+
+import os
+import json
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from utils.file_cache import cache_root, file_fingerprint
+except ModuleNotFoundError:
+    from file_cache import cache_root, file_fingerprint
+
+DB_NAME = 'metadata.sqlite'
+# sqlite's limit on bound parameters is 999 in older builds
+QUERY_CHUNK = 900
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS metadata (
+                kind TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (kind, path))'''
+
+
+def _fingerprint(path):
+    '''file_fingerprint of path, None if it cannot be stat'ed'''
+    try:
+        return file_fingerprint(path)
+    except OSError:
+        return None
+
+
+def stat_fingerprints(paths, max_workers=8):
+    '''file_fingerprint of each of paths (None where missing), stat'ed on a
+       thread pool so the network round trips overlap'''
+    if len(paths) < 2:
+        return [_fingerprint(path) for path in paths]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(_fingerprint, paths))
+
+
+class MetadataStore():
+
+    def __init__(self, db_path=None):
+        '''
+        Parsed metadata keyed by kind (e.g. 'pv', 'tiff') and file path
+
+        Inputs:
+        db_path -- sqlite database, DB_NAME in the cache root if None
+        '''
+
+        self.db_path = db_path if db_path is not None else \
+            os.path.join(cache_root(), DB_NAME)
+        self._ready = False
+
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)),
+                        exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if not self._ready:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(SCHEMA)
+            conn.commit()
+            self._ready = True
+        return closing(conn)
+
+    def get(self, kind, path, fingerprint=None, version=1):
+        '''returns the value cached for path or None if there is no value
+           for the file as it is now'''
+        return self.get_many(kind, [path], [fingerprint], version)[path]
+
+    def get_many(self, kind, paths, fingerprints=None, version=1):
+        '''
+        Cached values of many files with one query per QUERY_CHUNK paths
+
+        Inputs:
+        kind         -- kind of metadata
+        paths        -- files to look up
+        fingerprints -- file_fingerprint of each path, stat'ed if None
+        version      -- version of the parser, rows from others are stale
+
+        Returns {path: value or None}
+        '''
+
+        if fingerprints is None:
+            fingerprints = [None] * len(paths)
+        missing = [path for path, fp in zip(paths, fingerprints) if fp is None]
+        stat = dict(zip(missing, stat_fingerprints(missing)))
+        fingerprints = [fp if fp is not None else stat[path]
+                        for path, fp in zip(paths, fingerprints)]
+
+        keys = {os.path.abspath(path): (path, fp)
+                for path, fp in zip(paths, fingerprints)}
+        found = {path: None for path in paths}
+
+        with self._connect() as conn:
+            abs_paths = list(keys)
+            for i in range(0, len(abs_paths), QUERY_CHUNK):
+                chunk = abs_paths[i:i+QUERY_CHUNK]
+                rows = conn.execute(
+                    'SELECT path, size, mtime_ns, version, value FROM metadata '
+                    'WHERE kind = ? AND path IN ({})'.format(
+                        ','.join('?' * len(chunk))), [kind] + chunk)
+                for abs_path, size, mtime_ns, row_version, value in rows:
+                    path, fp = keys[abs_path]
+                    if fp == [size, mtime_ns] and row_version == version:
+                        found[path] = json.loads(value)
+
+        return found
+
+    def set(self, kind, path, value, fingerprint=None, version=1):
+        self.set_many(kind, {path: value}, {path: fingerprint}, version)
+
+    def set_many(self, kind, values, fingerprints=None, version=1):
+        '''
+        Caches {path: value} in one transaction, value must be json
+        serialisable. fingerprints is {path: file_fingerprint}, paths
+        without one are stat'ed
+        '''
+
+        fingerprints = fingerprints or {}
+        rows = []
+        for path, value in values.items():
+            fp = fingerprints.get(path) or file_fingerprint(path)
+            rows.append((kind, os.path.abspath(path), fp[0], fp[1], version,
+                         json.dumps(value)))
+
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO metadata VALUES '
+                             '(?, ?, ?, ?, ?, ?)', rows)
+            conn.commit()
+
+    def lookup(self, kind, path, parser, version=1):
+        '''value cached for path, else parser(path) which is then cached'''
+        return self.lookup_many(kind, [path], parser, version)[0]
+
+    def lookup_many(self, kind, paths, parser, version=1, max_workers=1):
+        '''
+        Values of many files, one query for the cached ones and parser(path)
+        for the rest, which are cached in one transaction. The database
+        being unusable (e.g. the local disk is full) only costs the parsing
+
+        Inputs:
+        kind        -- kind of metadata
+        paths       -- files to look up
+        parser      -- function of a path returning a json serialisable value
+        version     -- version of the parser, bump it when the value changes
+        max_workers -- parse the uncached files on a thread pool this size
+
+        Returns list of values in the order of paths
+        '''
+
+        fps = stat_fingerprints(paths)
+        try:
+            found = self.get_many(kind, paths, fps, version)
+        except (sqlite3.Error, OSError) as e:
+            print('Metadata store not used: {}'.format(e))
+            found = {path: None for path in paths}
+
+        todo = [path for path in dict.fromkeys(paths) if found[path] is None]
+        if todo:
+            if max_workers > 1 and len(todo) > 1:
+                with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                    parsed = dict(zip(todo, pool.map(parser, todo)))
+            else:
+                parsed = {path: parser(path) for path in todo}
+            found.update(parsed)
+
+            fp_of = dict(zip(paths, fps))
+            try:
+                self.set_many(kind, parsed, {path: fp_of[path]
+                                             for path in todo}, version)
+            except (sqlite3.Error, OSError) as e:
+                print('Could not store {} metadata: {}'.format(kind, e))
+
+        return [found[path] for path in paths]
+
+    def entries(self, kind):
+        '''{path: value} of everything cached of kind, without checking the
+           files are unchanged'''
+        with self._connect() as conn:
+            rows = conn.execute('SELECT path, value FROM metadata '
+                                'WHERE kind = ?', (kind,))
+            return {path: json.loads(value) for path, value in rows}
+
+    def remove(self, kind, path):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM metadata WHERE kind = ? AND path = ?',
+                         (kind, os.path.abspath(path)))
+            conn.commit()
+
+
+_store = None
+
+
+def default_store():
+    '''the MetadataStore shared by the analysis code'''
+    global _store
+    if _store is None:
+        _store = MetadataStore()
+    return _store
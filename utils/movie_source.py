@@ -0,0 +1,594 @@
+'''
+Random access to imaging movies on disk
+
+Every backend exposes the same MovieSource interface, shape, dtype and
+get_frames(indices), so STA and drift code can read just the frames it
+needs from a PrairieView .bin, Thor .raw, multipage TIFF or suite2p data.bin
+without loading the whole movie. Requested frames are sorted and coalesced
+into contiguous runs so each backend does as few reads as possible.
+'''
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tifffile
+
+try:
+    from utils import PrairieLink, ThorLink
+    from utils.file_cache import SidecarCache
+except ModuleNotFoundError:
+    import PrairieLink
+    import ThorLink
+    from file_cache import SidecarCache
+
+TIFF_INDEX = 'tiff_index.json'
+
+
+def contiguous_runs(frames):
+    '''splits sorted unique frame indices into (start, stop) runs of
+       consecutive frames'''
+
+    if len(frames) == 0:
+        return []
+
+    breaks = np.where(np.diff(frames) != 1)[0] + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(frames)]])
+
+    return [(int(frames[start]), int(frames[stop-1]) + 1)
+            for start, stop in zip(starts, stops)]
+
+
+class MovieSource():
+
+    '''
+    Base class of the movie backends, subclasses set shape and dtype and
+    implement _read_run(start, stop) returning frames start:stop as an array
+    '''
+
+    shape = None
+    dtype = None
+    # file the movie was read from, sidecars of derived data go next to it
+    source_path = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_run(self, start, stop):
+        raise NotImplementedError
+
+    def get_frames(self, indices):
+        '''
+        Returns the frames at indices as a frames x rows x cols array, in the
+        order requested (repeats allowed)
+
+        Inputs:
+        indices -- iterable of frame indices, negative counts from the end
+        '''
+
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if np.any((indices < 0) | (indices >= len(self))):
+            raise IndexError('frame indices out of range for movie of {} '
+                             'frames'.format(len(self)))
+
+        frames, inverse = np.unique(indices, return_inverse=True)
+
+        data = np.empty((len(frames),) + tuple(self.shape[1:]),
+                        dtype=self.dtype)
+        i = 0
+        for start, stop in contiguous_runs(frames):
+            data[i:i+stop-start] = self._read_run(start, stop)
+            i += stop - start
+
+        return data[inverse.reshape(-1)]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.get_frames(np.arange(*key.indices(len(self))))
+        if np.ndim(key) > 0:
+            return self.get_frames(key)
+        return self.get_frames([key])[0]
+
+
+class MemmapMovie(MovieSource):
+
+    def __init__(self, movie):
+        '''
+        Movie backed by anything that can be sliced into frames x rows x
+        cols, e.g. an np.memmap
+
+        Inputs:
+        movie -- frames x rows x cols array-like
+        '''
+
+        self.movie = movie
+        self.shape = tuple(movie.shape)
+        self.dtype = np.dtype(movie.dtype)
+
+    def _read_run(self, start, stop):
+        return np.asarray(self.movie[start:stop])
+
+
+class BinMovie(MemmapMovie):
+
+    def __init__(self, movie_path):
+        '''PrairieView .bin movie (4-byte header then uint16 frames)'''
+        self.movie_path = movie_path
+        self.source_path = movie_path
+        super().__init__(PrairieLink.ReadRawFile(movie_path, mmap=True))
+
+
+class RawMovie(MemmapMovie):
+
+    def __init__(self, movie_paths, pixels_per_line=None,
+                 lines_per_frame=None):
+        '''Thor .raw movie, or an ordered list of .raw files as one movie'''
+        self.movie_paths = movie_paths
+        if isinstance(movie_paths, str):
+            self.source_path = movie_paths
+        super().__init__(ThorLink.ThorRawMovie(movie_paths, pixels_per_line,
+                                               lines_per_frame))
+
+
+def _s2p_plane_path(s2p_path):
+    if os.path.isdir(s2p_path):
+        return s2p_path
+    return os.path.dirname(s2p_path)
+
+
+def load_s2p_ops(s2p_path):
+    '''
+    Returns (ops, path to the registered binary) of a suite2p plane
+
+    Inputs:
+    s2p_path -- plane folder, its ops.npy or data.bin. ops['reg_file'] is
+                used if it still exists (e.g. on fast_disk), otherwise the
+                data.bin next to ops.npy
+    '''
+
+    ops = np.load(os.path.join(_s2p_plane_path(s2p_path), 'ops.npy'),
+                  allow_pickle=True).item()
+
+    return ops, s2p_bin_path(s2p_path, ops)
+
+
+def s2p_bin_path(s2p_path, ops):
+    '''path to the registered binary of a suite2p plane whose ops are
+       already loaded, found as in load_s2p_ops'''
+
+    plane_path = _s2p_plane_path(s2p_path)
+
+    if s2p_path.endswith('.bin'):
+        bin_path = s2p_path
+    elif os.path.exists(ops.get('reg_file', '')):
+        bin_path = ops['reg_file']
+    else:
+        bin_path = os.path.join(plane_path, 'data.bin')
+
+    if not os.path.exists(bin_path):
+        raise FileNotFoundError('no registered binary for {}, was suite2p '
+                                'run with delete_bin False?'.format(s2p_path))
+
+    return bin_path
+
+
+class Suite2pBinMovie(MemmapMovie):
+
+    def __init__(self, s2p_path, ops=None):
+        '''
+        suite2p registered binary (int16 frames x Ly x Lx with no header),
+        memory-mapped so frames are read straight from the motion corrected
+        data with no copy
+
+        Inputs:
+        s2p_path -- plane folder, its ops.npy or data.bin
+        ops      -- suite2p ops dict with Ly and Lx, saves loading the
+                    ops.npy of the plane, the binary is found the same way
+
+        Attributes:
+        frame_offsets -- first frame of each tiff folder in the binary from
+                         ops['frames_per_folder'], the last element is the
+                         total, None if suite2p did not record them
+        '''
+
+        if ops is None:
+            ops, bin_path = load_s2p_ops(s2p_path)
+        else:
+            bin_path = s2p_bin_path(s2p_path, ops)
+
+        self.bin_path = bin_path
+        self.source_path = bin_path
+        self.ops = ops
+        frame_size = ops['Ly'] * ops['Lx']
+        num_frames = os.path.getsize(bin_path) // (2 * frame_size)
+        if 'nframes' in ops:
+            num_frames = min(num_frames, int(ops['nframes']))
+
+        if 'frames_per_folder' in ops:
+            self.frame_offsets = np.cumsum(
+                [0] + list(ops['frames_per_folder'])).astype(int)
+        else:
+            self.frame_offsets = None
+
+        super().__init__(np.memmap(bin_path, dtype=np.int16, mode='r',
+                                   shape=(num_frames, ops['Ly'], ops['Lx'])))
+
+    def subset(self, frames):
+        '''MemmapMovie of the consecutive frames in range frames, a view of
+           the same memory-map'''
+        return MemmapMovie(self.movie[frames.start:frames.stop])
+
+    def folder_frames(self, folder):
+        '''range of frames in the binary that came from tiff folder number
+           folder, as in interarealProcessing.getFrameRanges'''
+        assert self.frame_offsets is not None, \
+            'ops has no frames_per_folder'
+        return range(self.frame_offsets[folder], self.frame_offsets[folder+1])
+
+    def folder_movie(self, folder):
+        '''MemmapMovie of the frames from tiff folder number folder, indexed
+           from 0 at the start of that folder'''
+        return self.subset(self.folder_frames(folder))
+
+
+def _build_tiff_index(tif):
+    '''
+    Walks the IFD chain of an open TiffFile once, returning the json header
+    and the data offset of every page in series 0. Pages can only be read
+    by offset if they are all uncompressed, stored contiguously and belong
+    to this file (not an OME series spread over several files). A file
+    with pages outside series 0 (e.g. frames of a different shape) is not
+    one movie and raises ValueError rather than losing those frames
+    '''
+
+    pages = tif.series[0].pages
+    if len(pages) < len(tif.pages):
+        raise ValueError('series 0 of {} holds {} of its {} pages, expected '
+                         'one frame per page'.format(tif.filehandle.path,
+                                                     len(pages),
+                                                     len(tif.pages)))
+    first = pages[0]
+    dtype = np.dtype(first.dtype).newbyteorder(tif.byteorder)
+    frame_bytes = int(np.prod(first.shape)) * dtype.itemsize
+
+    offsets = np.zeros(len(pages), dtype=np.int64)
+    direct = len(pages) == len(tif.pages)
+    for i, page in enumerate(pages):
+        if not direct:
+            break
+        page_offsets = np.asarray(page.dataoffsets, dtype=np.int64)
+        page_bytes = np.asarray(page.databytecounts, dtype=np.int64)
+        direct = (int(page.compression) == 1 and
+                  tuple(page.shape) == tuple(first.shape) and
+                  page_bytes.sum() >= frame_bytes and
+                  np.all(page_offsets[1:] == page_offsets[:-1]
+                         + page_bytes[:-1]))
+        offsets[i] = page_offsets[0]
+
+    header = {'shape': [len(pages)] + list(first.shape),
+              'dtype': dtype.str,
+              'direct': bool(direct)}
+
+    return header, offsets
+
+
+def tiff_page_index(tiff_path, tif=None):
+    '''
+    Returns (header, offsets) of tiff_path where header holds the movie
+    shape, dtype and whether pages can be read directly by offset, and
+    offsets is the file offset of each page's data. The index is cached in
+    a sidecar next to the tiff so the IFD chain is only walked once per file
+
+    Inputs:
+    tiff_path -- path to the tiff
+    tif       -- already open TiffFile of tiff_path, opened if needed
+    '''
+
+    try:
+        cache = SidecarCache(tiff_path)
+        header = cache.load_json(TIFF_INDEX)
+        offsets = cache.load_array('page_offsets.npy')
+    except OSError:
+        cache, header, offsets = None, None, None
+
+    if header is not None and offsets is not None:
+        return header, offsets
+
+    if tif is None:
+        with tifffile.TiffFile(tiff_path) as tif:
+            header, offsets = _build_tiff_index(tif)
+    else:
+        header, offsets = _build_tiff_index(tif)
+
+    if cache is not None:
+        try:
+            cache.save_array('page_offsets.npy', offsets)
+            cache.save_json(TIFF_INDEX, header)
+        except OSError as e:
+            print('Could not cache tiff index of {}: {}'.format(tiff_path, e))
+
+    return header, offsets
+
+
+class TiffMovie(MovieSource):
+
+    def __init__(self, tiff_path):
+        '''
+        Multipage TIFF movie, one frame per page. OME-TIFF series split over
+        several files are read as one movie
+
+        Uncompressed single-file tiffs (e.g. Bruker stacks) are read by page
+        offset from a cached index without walking the IFD chain. If the
+        pages are evenly spaced the whole movie is a strided memory-map,
+        otherwise each page is read at its offset. Anything else goes
+        through tifffile
+
+        Inputs:
+        tiff_path -- path to the (first) tiff file
+        '''
+
+        self.tiff_path = tiff_path
+        self.source_path = tiff_path
+        self._tif = None
+        self._tif_lock = threading.Lock()
+
+        header, self.offsets = tiff_page_index(tiff_path)
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.direct = header['direct']
+
+        self.movie = None
+        if self.direct:
+            self.movie = self._strided_memmap()
+
+    @property
+    def tif(self):
+        if self._tif is None:
+            self._tif = tifffile.TiffFile(self.tiff_path)
+        return self._tif
+
+    def _strided_memmap(self):
+        '''memory-map of all pages if they are evenly spaced, else None'''
+
+        frame_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+        steps = np.diff(self.offsets)
+        if len(steps) and not np.all(steps == steps[0]):
+            return None
+        step = int(steps[0]) if len(steps) else frame_bytes
+
+        total_bytes = step * (self.shape[0] - 1) + frame_bytes
+        mm = np.memmap(self.tiff_path, dtype=np.uint8, mode='r',
+                       offset=int(self.offsets[0]), shape=(total_bytes,))
+
+        strides = (step,) + tuple(np.cumprod(
+            [self.dtype.itemsize] + list(self.shape[:0:-1]))[-2::-1])
+
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=mm,
+                          strides=strides)
+
+    def _read_run(self, start, stop):
+        if self.movie is not None:
+            return np.array(self.movie[start:stop])
+
+        if self.direct:
+            count = int(np.prod(self.shape[1:]))
+            data = np.empty((stop - start,) + self.shape[1:],
+                            dtype=self.dtype)
+            with open(self.tiff_path, 'rb') as f:
+                for i, offset in enumerate(self.offsets[start:stop]):
+                    f.seek(int(offset))
+                    data[i] = np.fromfile(f, dtype=self.dtype, count=count
+                                          ).reshape(self.shape[1:])
+            return data
+
+        with self._tif_lock:
+            data = self.tif.asarray(key=range(start, stop), series=0)
+        return data.reshape((stop - start,) + self.shape[1:])
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+
+
+class TiffStackWriter():
+
+    def __init__(self, tiff_path, bigtiff=True):
+        '''
+        Streams frame blocks into a single contiguous multipage (Big)TIFF,
+        so movies larger than memory can be written. The frame count in
+        the description is filled in when the writer is closed
+
+        Inputs:
+        tiff_path -- path of the tiff to write
+        bigtiff   -- write a BigTIFF (needed past 4 GB)
+
+        Use as a context manager or call close() when done
+        '''
+
+        self.tiff_path = tiff_path
+        self.num_frames = 0
+        self.tif = tifffile.TiffWriter(tiff_path, bigtiff=bigtiff)
+        # older tifffile calls this save
+        self._write = getattr(self.tif, 'write', None) or self.tif.save
+
+    def write(self, frames):
+        '''appends frames (frames x rows x cols block, or a single frame)'''
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        for frame in frames:
+            self._write(frame, contiguous=True, photometric='minisblack')
+        self.num_frames += frames.shape[0]
+
+    def close(self):
+        self.tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_writer(movie_path, frame_shape, **kwargs):
+    '''
+    Returns a streaming writer for movie_path with write(frames) and
+    close() chosen by extension, .bin (PrairieLink), .raw (Thor) or
+    .tif/.tiff (BigTIFF)
+
+    Inputs:
+    movie_path  -- path of the movie to write
+    frame_shape -- (rows, cols) of each frame
+    '''
+
+    ext = os.path.splitext(movie_path)[1].lower()
+    if ext == '.bin':
+        return PrairieLink.RawFileWriter(movie_path, *frame_shape)
+    elif ext == '.raw':
+        return ThorLink.RawFileWriter(movie_path, *frame_shape)
+    elif ext in ('.tif', '.tiff'):
+        return TiffStackWriter(movie_path, **kwargs)
+    else:
+        raise ValueError('no movie writer for {}'.format(movie_path))
+
+
+def prefetch_windows(movie, windows, max_workers=4, max_pending=8):
+    '''
+    Reads windows of frames (e.g. the frames around each stim) on a thread
+    pool ahead of the caller, yielding (window index, frames) in the order
+    of windows. At most max_pending windows are read or waiting at once,
+    so memory stays bounded while reading overlaps with whatever the caller
+    does with each window
+
+    Inputs:
+    movie       -- MovieSource to read from
+    windows     -- list of frame index arrays, one per window
+    max_workers -- number of reader threads
+    max_pending -- number of windows read ahead of the caller
+    '''
+
+    max_pending = max(max_pending, 1)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        windows = iter(enumerate(windows))
+
+        for i, window in windows:
+            pending.append((i, pool.submit(movie.get_frames, window)))
+            if len(pending) >= max_pending:
+                break
+
+        while pending:
+            i, future = pending.popleft()
+            for j, window in windows:
+                pending.append((j, pool.submit(movie.get_frames, window)))
+                break
+            yield i, future.result()
+
+
+FRAME_STATS = 'frame_stats.npy'
+
+
+def movie_frame_stats(movie, percentiles=(1, 50, 99), crop=0.5,
+                      block_size=500, use_cache=True):
+    '''
+    Per-frame summary statistics of a movie, computed in one streaming pass
+    and cached in a sidecar next to the movie, so drift, bleaching and
+    artifact checks read a few KB rather than the whole movie again
+
+    Inputs:
+    movie       -- MovieSource or path accepted by open_movie
+    percentiles -- pixel percentiles recorded for each frame
+    crop        -- fraction of the frame (centred) the crop max is taken from
+    block_size  -- number of frames read at a time
+    use_cache   -- load / save the sidecar
+
+    Returns structured array with one row per frame and fields mean, one
+    p<percentile> per percentile (e.g. p50) and crop_max
+    '''
+
+    if not isinstance(movie, MovieSource):
+        movie = open_movie(movie)
+
+    names = ['mean'] + ['p{}'.format(p) for p in percentiles] + ['crop_max']
+    dtype = np.dtype([(name, np.float32) for name in names])
+    params = {'percentiles': list(percentiles), 'crop': crop}
+
+    cache = None
+    if use_cache and movie.source_path is not None:
+        try:
+            cache = SidecarCache(movie.source_path)
+            stats = cache.load_array(FRAME_STATS)
+            if stats is not None and cache.load_json(
+                    FRAME_STATS + '.json') == params and \
+               len(stats) == len(movie):
+                return stats
+        except OSError:
+            cache = None
+
+    rows, cols = movie.shape[1], movie.shape[2]
+    row0, col0 = int(rows * (1 - crop) / 2), int(cols * (1 - crop) / 2)
+    crop_rows = slice(row0, max(rows - row0, row0 + 1))
+    crop_cols = slice(col0, max(cols - col0, col0 + 1))
+
+    stats = np.zeros(len(movie), dtype=dtype)
+    windows = [range(start, min(start + block_size, len(movie)))
+               for start in range(0, len(movie), block_size)]
+
+    for i, block in prefetch_windows(movie, windows, max_workers=2,
+                                     max_pending=2):
+        frames = windows[i]
+        block = block.astype(np.float32)
+        flat = block.reshape(block.shape[0], -1)
+
+        stats['mean'][frames.start:frames.stop] = flat.mean(axis=1)
+        for p, value in zip(percentiles,
+                            np.percentile(flat, percentiles, axis=1)):
+            stats['p{}'.format(p)][frames.start:frames.stop] = value
+        stats['crop_max'][frames.start:frames.stop] = \
+            block[:, crop_rows, crop_cols].reshape(block.shape[0], -1).max(axis=1)
+
+    if cache is not None:
+        try:
+            cache.save_array(FRAME_STATS, stats)
+            cache.save_json(FRAME_STATS + '.json', params)
+        except OSError as e:
+            print('Could not cache frame stats of {}: {}'.format(
+                movie.source_path, e))
+
+    return stats
+
+
+def open_movie(movie_path, **kwargs):
+    '''
+    Returns the MovieSource backend for movie_path
+
+    Inputs:
+    movie_path -- .bin (PrairieView, or suite2p if there is an ops.npy next
+                  to it), suite2p plane folder, .raw or list of .raw
+                  (Thor), .tif/.tiff
+    kwargs     -- passed to the backend
+    '''
+
+    if isinstance(movie_path, (list, tuple)):
+        return RawMovie(movie_path, **kwargs)
+
+    if os.path.isdir(movie_path):
+        return Suite2pBinMovie(movie_path, **kwargs)
+
+    ext = os.path.splitext(movie_path)[1].lower()
+    if ext == '.bin':
+        ops_path = os.path.join(os.path.dirname(movie_path), 'ops.npy')
+        if os.path.exists(ops_path):
+            return Suite2pBinMovie(movie_path, **kwargs)
+        return BinMovie(movie_path, **kwargs)
+    elif ext == '.raw':
+        return RawMovie(movie_path, **kwargs)
+    elif ext in ('.tif', '.tiff'):
+        return TiffMovie(movie_path, **kwargs)
+    else:
+        raise ValueError('no movie backend for {}'.format(movie_path))
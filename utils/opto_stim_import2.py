@@ -7,7 +7,8 @@ from data_import import Session
 from utils_funcs import paq_data
 from utils_funcs import d_prime as pade_dprime
 import gsheets_importer as gsheet
-from paq2py import paq_read
+from paq2py import paq_read, open_paq, paq_digital_edges
+from local_cache import local_path, SERVER_PATH
 from rsync_aligner import Rsync_aligner
 import re
 from ntpath import basename
@@ -294,7 +295,7 @@ class BlimpImport(OptoStim2p):
                  '1nFdqJv1aZk36CrBpRZPjRuOTHUKX8SXuVW9pa89OIHY',
                  '1Cnt8-e7rGFMlvkRwkiT2BlWC4Ll6uvC9iO3dVugyMbM']
 
-    server_path = '/home/jrowland/mnt/qnap/Data'
+    server_path = SERVER_PATH
 
     # the column headers of the spreadsheet 
     date_header = 'Date'
@@ -436,8 +437,16 @@ class BlimpImport(OptoStim2p):
         # folder starts with iso-standard date to match the Data umbrella folder
         naparm_umbrella = os.path.join(BlimpImport.server_path, naparm[:10])
         self.naparm_path = gsheet.path_finder(naparm_umbrella, naparm, is_folder=True)
-        self.pycontrol_path, self.paq_path, self.prereward_path =\
-        gsheet.path_finder(umbrella, pycontrol, paq, prereward, is_folder=False)
+        self.pycontrol_path, self.prereward_path =\
+        gsheet.path_finder(umbrella, pycontrol, prereward, is_folder=False)
+        # a paq that was stopped and restarted during the run is listed as 
+        # several newline separated files, these are stitched into one 
+        # timeline by PaqSession
+        if isinstance(paq, list):
+            self.paq_path = [gsheet.path_finder(umbrella, p, is_folder=False)[0]
+                             for p in paq]
+        else:
+            self.paq_path = gsheet.path_finder(umbrella, paq, is_folder=False)[0]
         
         if tseries == 'None' or not tseries:
             self.tseries_paths = None
@@ -467,17 +476,26 @@ class BlimpImport(OptoStim2p):
             print('pycontrol {} successfully matched to blimp folder {}'
                   .format(pycontrol, blimp))
 
-        # read the paq file and get out useful info
-        _paq_obj = paq_read(self.paq_path)
-
-        self.paq_rsync = paq_data(_paq_obj, 'pycontrol_rsync', 
-                                 threshold_ttl=True, plot=False)
-        self.frame_clock = paq_data(_paq_obj, 'frame_clock', 
-                                    threshold_ttl=True, plot=False)
+        # memory map the paq file(s) and get out useful info, the channels are
+        # decoded to a native-endian sidecar the first time a run is loaded
+        # paqs are staged to the local cache so later loads skip the nas
+        if isinstance(self.paq_path, list):
+            _paq_local = [local_path(p, stage=True) for p in self.paq_path]
+        else:
+            _paq_local = local_path(self.paq_path, stage=True)
+        _paq_obj = open_paq(_paq_local, make_sidecar=True)
+        self.paq_name = ', '.join(basename(p) for p in 
+                                  np.atleast_1d(self.paq_path))
+
+        # all digital channels decoded in a single pass over the paq
+        _paq_edges = paq_digital_edges(_paq_obj, ['pycontrol_rsync',
+                                                  'frame_clock',
+                                                  'slm2packio'])
+        self.paq_rsync = _paq_edges['pycontrol_rsync']
+        self.frame_clock = _paq_edges['frame_clock']
         self.x_galvo_uncaging = paq_data(_paq_obj, 'x_galvo_uncaging', 
                                          threshold_ttl=False, plot=False)
-        self.slm2packio = paq_data(_paq_obj, 'slm2packio', threshold_ttl=True,
-                                   plot=False)
+        self.slm2packio = _paq_edges['slm2packio']
         self.paq_rate = _paq_obj['rate']
 
         try:
@@ -489,8 +507,7 @@ class BlimpImport(OptoStim2p):
 
             self.paq_correct = True
             print('pycontrol {} rsync successfully matched to paq {}'.
-                   format(basename(self.prereward_path), 
-                          basename(self.paq_path)))
+                   format(basename(self.prereward_path), self.paq_name))
         except Exception as e:
             print(e)
             self.paq_correct = False
@@ -511,14 +528,9 @@ class BlimpImport(OptoStim2p):
         self.pre_licks = prereward_session.times.get('lick_1')
         self.pre_reward = prereward_session.times.get('reward')
 
-        ## workaround for if accidently stop paq after prereward
-        # pre_paq_path = '/home/jrowland/mnt/qnap/Data/2019-12-16/'\
-                       # '2019-12-14_J064_t003.paq'
-
-        # _pre_paq = paq_read(pre_paq_path)
-
-        # _pre_paq_rsync = paq_data(_pre_paq, 'pycontrol_rsync', 
-                                 # threshold_ttl=True, plot=False)
+        # if the paq was accidently stopped after prereward, list both paqs 
+        # in the '.paq file' cell, self.paq_rsync is then on the stitched
+        # timeline of the two files
 
         try:
             self.prereward_aligner = Rsync_aligner(pulse_times_A=self.pre_rsync,
@@ -528,7 +540,7 @@ class BlimpImport(OptoStim2p):
                                                    raise_exception=True)
             self.paq_correct = True
             print('prereward {} rsync successfully matched to paq {}'.
-                   format(basename(self.prereward_path), basename(self.paq_path)))
+                   format(basename(self.prereward_path), self.paq_name))
         except:
             self.paq_correct = False
             error_str = 'prereward rsync does not match paq'
@@ -4,10 +4,58 @@ Read PAQ file (from PackIO) into python
 Lloyd Russell 2015
 """
 
+import os
 import numpy as np
+try:
+    from utils.file_cache import SidecarCache
+except ModuleNotFoundError:
+    from file_cache import SidecarCache
 
+# name of the json header written to the sidecar by paq_to_sidecar
+PAQ_HEADER = 'paq_header.json'
 
-def paq_read(file_path=None, plot=False):
+# keys of the dict returned by paq_read, also accepted by PaqFile
+PAQ_KEYS = ('data', 'chan_names', 'hw_chans', 'units', 'rate', 'file_path')
+
+
+def _chan_file(chan_idx):
+    '''name of the sidecar .npy holding channel chan_idx'''
+    return 'chan{}.npy'.format(chan_idx)
+
+
+def _edges_file(chan_idx, threshold):
+    '''name of the sidecar .npy holding the edges of channel chan_idx'''
+    return 'edges{}_{}.npy'.format(chan_idx, float(threshold))
+
+
+def _read_paq_header(fid):
+    '''
+    Parse the PackIO header from an open paq file, leaving fid positioned at
+    the first sample of the data body. Every header field is stored as a
+    big-endian float32, strings as a length followed by one float per char
+    '''
+
+    def read_floats(count):
+        return np.fromfile(fid, dtype='>f', count=count)
+
+    def read_strings(num_strings):
+        strings = []
+        for i in range(num_strings):
+            num_chars = int(read_floats(1)[0])
+            strings.append(''.join(chr(int(c)) for c in read_floats(num_chars)))
+        return strings
+
+    rate = int(read_floats(1)[0])
+    num_chans = int(read_floats(1)[0])
+
+    chan_names = read_strings(num_chans)
+    hw_chans = read_strings(num_chans)
+    units = read_strings(num_chans)
+
+    return rate, chan_names, hw_chans, units
+
+
+def paq_read(file_path=None, plot=False, use_sidecar=True):
     """
     Read PAQ file (from PackIO) into python
     Lloyd Russell 2015
@@ -18,6 +66,9 @@ def paq_read(file_path=None, plot=False):
         is opened, buggy on mac osx - Tk/matplotlib. Default: None.
     plot : bool, optional
         plot the data after reading? Default: False.
+    use_sidecar : bool, optional
+        load the native-endian channels written by paq_to_sidecar if they
+        exist and the paq has not changed since. Default: True.
     Returns
     =======
     data : ndarray
@@ -31,6 +82,8 @@ def paq_read(file_path=None, plot=False):
         the units of measurement for each channel
     rate : int
         the acquisition sample rate, in Hz
+    file_path : str
+        the path the paq was read from, used to cache edges (see paq_edges)
     """
 
     # file load gui
@@ -42,49 +95,42 @@ def paq_read(file_path=None, plot=False):
         file_path = tkFileDialog.askopenfilename()
         root.destroy()
 
-    # open file
-    fid = open(file_path, 'rb')
-
-    # get sample rate
-    rate = int(np.fromfile(fid, dtype='>f', count=1))
-
-    # get number of channels
-    num_chans = int(np.fromfile(fid, dtype='>f', count=1))
-
-    # get channel names
-    chan_names = []
-    for i in range(num_chans):
-        num_chars = int(np.fromfile(fid, dtype='>f', count=1))
-        chan_name = ''
-        for j in range(num_chars):
-            chan_name = chan_name + chr(np.fromfile(fid, dtype='>f', count=1))
-        chan_names.append(chan_name)
-
-    # get channel hardware lines
-    hw_chans = []
-    for i in range(num_chans):
-        num_chars = int(np.fromfile(fid, dtype='>f', count=1))
-        hw_chan = ''
-        for j in range(num_chars):
-            hw_chan = hw_chan + chr(np.fromfile(fid, dtype='>f', count=1))
-        hw_chans.append(hw_chan)
-
-    # get acquisition units
-    units = []
-    for i in range(num_chans):
-        num_chars = int(np.fromfile(fid, dtype='>f', count=1))
-        unit = ''
-        for j in range(num_chars):
-            unit = unit + chr(np.fromfile(fid, dtype='>f', count=1))
-        units.append(unit)
-
-    # get data
-    temp_data = np.fromfile(fid, dtype='>f', count=-1)
-    num_datapoints = int(len(temp_data)/num_chans)
-    data = np.reshape(temp_data, [num_datapoints, num_chans]).transpose()
-
-    # close file
-    fid.close()
+    sidecar = SidecarCache(file_path)
+    header = sidecar.load_json(PAQ_HEADER) if use_sidecar else None
+
+    if header is not None:
+        # channels already decoded by paq_to_sidecar
+        rate = header['rate']
+        chan_names = header['chan_names']
+        hw_chans = header['hw_chans']
+        units = header['units']
+        num_chans = len(chan_names)
+        num_datapoints = header['num_datapoints']
+        data = np.vstack([sidecar.load_array(_chan_file(chan_idx))
+                          for chan_idx in range(num_chans)])
+
+    else:
+        # open file
+        fid = open(file_path, 'rb')
+
+        # get sample rate, channel names, hardware lines and units
+        rate, chan_names, hw_chans, units = _read_paq_header(fid)
+        num_chans = len(chan_names)
+
+        # get data
+        temp_data = np.fromfile(fid, dtype='>f', count=-1)
+        num_datapoints = int(len(temp_data)/num_chans)
+        data = np.reshape(temp_data, [num_datapoints, num_chans]).transpose()
+
+        # close file
+        fid.close()
+
+    paq = {"data": data,
+           "chan_names": chan_names,
+           "hw_chans": hw_chans,
+           "units": units,
+           "rate": rate,
+           "file_path": file_path}
 
     # plot
     if plot:
@@ -93,14 +139,700 @@ def paq_read(file_path=None, plot=False):
         import matplotlib.pylab as plt
         f, axes = plt.subplots(num_chans, 1, sharex=True)
         for idx, ax in enumerate(axes):
-            ax.plot(data[idx])
-            ax.set_xlim([0, num_datapoints-1])
+            # min/max envelope rather than millions of raw samples, the
+            # pyramid is cached in the paq's sidecar after the first plot
+            plot_envelope(ax, paq_pyramid(paq, chan_names[idx]),
+                          signal=data[idx])
             ax.set_ylabel(units[idx])
             ax.set_title(chan_names[idx])
         plt.show()
 
-    return {"data": data,
-            "chan_names": chan_names,
-            "hw_chans": hw_chans,
-            "units": units,
-            "rate": rate}
+    return paq
+
+
+def _rising_idx(high, prev_high):
+    '''indices in boolean chunk high that go high, prev_high is whether
+       the sample before the chunk was high'''
+    rising = high.copy()
+    rising[1:] &= ~high[:-1]
+    rising[0] &= not prev_high
+    return np.flatnonzero(rising)
+
+
+def iter_rising_edges(signal, threshold, chunk_size=2**20):
+    '''
+    Walk signal in chunks of chunk_size samples, yielding an array of the
+    sample indices that cross above threshold in each chunk. Gives the same
+    edges as utils_funcs.threshold_detect but peak memory is set by
+    chunk_size rather than the length of the recording. Whether the last
+    sample of a chunk was high is carried into the next chunk so edges on
+    chunk boundaries are neither missed nor counted twice
+
+    Inputs:
+    signal     -- anything sliceable with a length, e.g. a PaqChannel,
+                  memmap, h5py dataset or ndarray. A (samples, 1) column
+                  such as a Thor sync line is read as its first column
+    threshold  -- value above which the signal is considered high
+    chunk_size -- number of samples thresholded at a time
+    '''
+
+    prev_high = False
+
+    for start in range(0, len(signal), chunk_size):
+        chunk = np.asarray(signal[start:start+chunk_size])
+        high = chunk.reshape(len(chunk), -1)[:, 0] > threshold
+        if len(high) == 0:
+            continue
+
+        yield _rising_idx(high, prev_high) + start
+        prev_high = bool(high[-1])
+
+
+def threshold_detect_chunked(signal, threshold, chunk_size=2**20):
+    '''returns the sample indices at which signal crosses above threshold,
+       streamed in chunks (see iter_rising_edges)'''
+
+    edges = list(iter_rising_edges(signal, threshold, chunk_size))
+    if not edges:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(edges).astype(np.int64)
+
+
+def _paq_sidecar(paq):
+    '''the SidecarCache of a PaqFile or paq_read dict, None if the paq
+       does not know which file it came from'''
+    if hasattr(paq, 'sidecar'):
+        return paq.sidecar
+    if 'file_path' in paq and paq['file_path'] is not None:
+        return SidecarCache(paq['file_path'])
+    return None
+
+
+def paq_edges(paq, chan_name, threshold=1, chunk_size=2**20):
+    '''
+    Rising edges (sample indices) of channel chan_name, cached as int64 in
+    the paq's sidecar keyed on channel and threshold. The cache is dropped
+    whenever the paq file changes, so once a session has been analysed its
+    digital events are loaded without touching the analog data
+
+    Inputs:
+    paq        -- PaqFile, PaqSession, dict from paq_read or path to a .paq
+    chan_name  -- name of the channel to detect edges on
+    threshold  -- value above which the channel is considered high
+    chunk_size -- samples per chunk if the edges have to be detected
+    '''
+
+    return paq_digital_edges(paq, [chan_name], threshold, chunk_size)[chan_name]
+
+
+def paq_digital_edges(paq, chan_names, thresholds=1, chunk_size=2**20):
+    '''
+    Rising edges of several digital channels from a single chunked pass over
+    the paq. Reading the interleaved body once for all channels, rather
+    than once per channel, divides the I/O by the number of channels.
+    Edges already cached by paq_edges are loaded rather than recomputed,
+    and newly detected edges are added to the cache
+
+    Inputs:
+    paq        -- PaqFile, PaqSession, dict from paq_read or path to a .paq
+    chan_names -- list of the channel names to detect edges on
+    thresholds -- value above which each channel is considered high,
+                  either one value for all channels or one per channel
+    chunk_size -- samples per chunk if the edges have to be detected
+
+    Returns dict of chan_name: int64 array of rising edge sample indices
+    '''
+
+    if isinstance(paq, str):
+        paq = PaqFile(paq)
+
+    if isinstance(paq, PaqSession):
+        return paq.digital_edges(chan_names, thresholds, chunk_size)
+
+    if np.isscalar(thresholds):
+        thresholds = [thresholds] * len(chan_names)
+    assert len(thresholds) == len(chan_names), \
+        'need one threshold per channel or a single threshold'
+
+    chan_idxs = [paq['chan_names'].index(chan_name)
+                 for chan_name in chan_names]
+
+    sidecar = _paq_sidecar(paq)
+
+    edges = {}
+    if sidecar is not None:
+        for chan_name, chan_idx, threshold in zip(chan_names, chan_idxs,
+                                                  thresholds):
+            cached = sidecar.load_array(_edges_file(chan_idx, threshold),
+                                        mmap_mode=None)
+            if cached is not None:
+                edges[chan_name] = cached
+
+    to_detect = [i for i, chan_name in enumerate(chan_names)
+                 if chan_name not in edges]
+    if not to_detect:
+        return edges
+
+    detect_idxs = [chan_idxs[i] for i in to_detect]
+    detect_thresholds = np.array([thresholds[i] for i in to_detect])
+
+    if hasattr(paq, 'channel') and not paq.has_sidecar:
+        # rows of the interleaved body are contiguous on disk
+        num_datapoints = paq.num_datapoints
+        def read_block(start, stop):
+            return np.asarray(paq._body[start:stop, detect_idxs],
+                              dtype=np.float32)
+    elif hasattr(paq, 'channel'):
+        # channels are already columnar in the sidecar
+        num_datapoints = paq.num_datapoints
+        chans = [paq.channel(chan_names[i]) for i in to_detect]
+        def read_block(start, stop):
+            return np.stack([chan[start:stop] for chan in chans], axis=1)
+    else:
+        num_datapoints = paq['data'].shape[1]
+        def read_block(start, stop):
+            return paq['data'][detect_idxs, start:stop].T
+
+    prev_high = np.zeros(len(to_detect), dtype=bool)
+    chunk_edges = [[] for i in to_detect]
+
+    for start in range(0, num_datapoints, chunk_size):
+        stop = min(start + chunk_size, num_datapoints)
+        high = read_block(start, stop) > detect_thresholds
+        for i in range(len(to_detect)):
+            chunk_edges[i].append(_rising_idx(high[:, i], prev_high[i])
+                                  + start)
+        prev_high = high[-1]
+
+    for i, detect_i in enumerate(to_detect):
+        chan_name = chan_names[detect_i]
+        if chunk_edges[i]:
+            edges[chan_name] = np.concatenate(chunk_edges[i]).astype(np.int64)
+        else:
+            edges[chan_name] = np.array([], dtype=np.int64)
+
+        if sidecar is not None:
+            try:
+                sidecar.save_array(_edges_file(chan_idxs[detect_i],
+                                               thresholds[detect_i]),
+                                   edges[chan_name])
+            except OSError as e:
+                print('Could not cache {} edges: {}'.format(chan_name, e))
+
+    return edges
+
+
+def minmax_pyramid(signal, factor=16, min_blocks=1024, chunk_size=2**20):
+    '''
+    Multi-level min/max envelope of signal. Level 0 holds the min and max
+    of each block of factor samples, level n of each block of
+    factor**(n+1) samples, stopping once a level has min_blocks or fewer
+    blocks. Built in a single chunked pass so signal can be a memmap or
+    PaqChannel of any length
+
+    Returns list of (n_blocks, 2) float32 arrays of [min, max], finest first
+    '''
+
+    num_samples = len(signal)
+    if num_samples == 0:
+        return []
+
+    chunk_size = max(chunk_size // factor, 1) * factor
+    level = np.empty((-(-num_samples // factor), 2), dtype=np.float32)
+
+    for start in range(0, num_samples, chunk_size):
+        chunk = np.asarray(signal[start:start+chunk_size], dtype=np.float32)
+        block_starts = np.arange(0, len(chunk), factor)
+        block = start // factor
+        level[block:block+len(block_starts), 0] = \
+            np.minimum.reduceat(chunk, block_starts)
+        level[block:block+len(block_starts), 1] = \
+            np.maximum.reduceat(chunk, block_starts)
+
+    pyramid = [level]
+    while len(level) > min_blocks:
+        block_starts = np.arange(0, len(level), factor)
+        level = np.stack((np.minimum.reduceat(level[:, 0], block_starts),
+                          np.maximum.reduceat(level[:, 1], block_starts)),
+                         axis=1)
+        pyramid.append(level)
+
+    return pyramid
+
+
+def paq_pyramid(paq, chan_name, factor=16):
+    '''
+    minmax_pyramid of channel chan_name, cached level by level in the paq's
+    sidecar so it is only built once per paq file
+
+    Inputs:
+    paq       -- PaqFile, dict from paq_read or path to a .paq file
+    chan_name -- name of the (analog) channel
+    factor    -- number of blocks of each level that make a block of the next
+    '''
+
+    if isinstance(paq, str):
+        paq = PaqFile(paq)
+
+    chan_idx = paq['chan_names'].index(chan_name)
+    sidecar = _paq_sidecar(paq)
+    name = 'pyramid{}_{}'.format(chan_idx, factor)
+
+    if sidecar is not None:
+        info = sidecar.load_json(name + '.json')
+        if info is not None:
+            return [sidecar.load_array('{}_{}.npy'.format(name, level))
+                    for level in range(info['num_levels'])]
+
+    if hasattr(paq, 'channel'):
+        signal = paq.channel(chan_name)
+    else:
+        signal = paq['data'][chan_idx, :]
+
+    pyramid = minmax_pyramid(signal, factor=factor)
+
+    if sidecar is not None:
+        try:
+            for level, envelope in enumerate(pyramid):
+                sidecar.save_array('{}_{}.npy'.format(name, level), envelope)
+            sidecar.save_json(name + '.json', {'num_levels': len(pyramid)})
+        except OSError as e:
+            print('Could not cache {} pyramid: {}'.format(chan_name, e))
+
+    return pyramid
+
+
+def plot_envelope(ax, pyramid, factor=16, signal=None, max_points=4000,
+                  **kwargs):
+    '''
+    Level-of-detail plot of a long signal on ax from its min/max pyramid.
+    The coarsest level that still gives max_points across the visible
+    x range is drawn as a min/max band, redrawn whenever the x limits
+    change, and the raw samples are drawn once zoomed in far enough
+    (if signal is given). x axis is in samples
+
+    Inputs:
+    ax         -- matplotlib axis to plot on
+    pyramid    -- from minmax_pyramid or paq_pyramid
+    factor     -- factor the pyramid was built with
+    signal     -- optional raw signal (array, memmap or PaqChannel)
+    max_points -- max number of points to draw at once
+    kwargs     -- passed to the matplotlib plotting functions
+    '''
+
+    if signal is not None:
+        num_samples = len(signal)
+    else:
+        num_samples = len(pyramid[0]) * factor
+
+    kwargs.setdefault('color', 'C0')
+    kwargs.setdefault('linewidth', 0.5)
+    artists = []
+
+    def draw(x_start, x_stop):
+        for artist in artists:
+            artist.remove()
+        del artists[:]
+
+        x_start = max(int(x_start), 0)
+        x_stop = min(int(np.ceil(x_stop)) + 1, num_samples)
+
+        if signal is not None and (x_stop - x_start <= max_points
+                                   or not pyramid):
+            x = np.arange(x_start, x_stop)
+            artists.extend(ax.plot(x, signal[x_start:x_stop], **kwargs))
+            return
+
+        for level, envelope in enumerate(pyramid):
+            block = factor ** (level + 1)
+            if (x_stop - x_start) / block <= max_points:
+                break
+
+        block_start = x_start // block
+        block_stop = -(-x_stop // block)
+        envelope = envelope[block_start:block_stop]
+        x = np.arange(block_start, block_start + len(envelope)) * block
+        artists.append(ax.fill_between(x, envelope[:, 0], envelope[:, 1],
+                                       step='post', **kwargs))
+
+    def on_xlim_changed(ax):
+        draw(*ax.get_xlim())
+        ax.figure.canvas.draw_idle()
+
+    draw(0, num_samples)
+    ax.set_xlim([0, num_samples-1])
+    ax.callbacks.connect('xlim_changed', on_xlim_changed)
+
+
+def paq_to_sidecar(file_path, chunk_size=2**20):
+    '''
+    Decode each channel of a paq file once into its own native-endian
+    float32 .npy in the paq's sidecar folder (see file_cache), with the
+    header saved alongside as json. While the paq is unchanged, paq_read and
+    PaqFile load channels from the sidecar (memory-mapped, no byte-swapping)
+
+    Inputs:
+    file_path  -- path to the .paq file, or an open PaqFile
+    chunk_size -- number of samples decoded per pass over the body
+
+    Returns the path of the sidecar folder
+    '''
+
+    if isinstance(file_path, PaqFile):
+        paq = file_path
+    else:
+        paq = PaqFile(file_path)
+
+    sidecar = paq.sidecar
+    num_chans = len(paq.chan_names)
+
+    chans = [sidecar.create_array(_chan_file(chan_idx),
+                                  (paq.num_datapoints,), np.float32)
+             for chan_idx in range(num_chans)]
+
+    # a single sequential read of the interleaved body
+    for start in range(0, paq.num_datapoints, chunk_size):
+        stop = min(start + chunk_size, paq.num_datapoints)
+        block = np.asarray(paq._body[start:stop], dtype=np.float32)
+        for chan_idx, chan in enumerate(chans):
+            chan[start:stop] = block[:, chan_idx]
+
+    for chan_idx, chan in enumerate(chans):
+        chan.flush()
+        sidecar.commit(_chan_file(chan_idx))
+    del chans
+
+    # written last, marks the sidecar as complete
+    sidecar.save_json(PAQ_HEADER, {'rate': paq.rate,
+                                   'chan_names': paq.chan_names,
+                                   'hw_chans': paq.hw_chans,
+                                   'units': paq.units,
+                                   'num_datapoints': paq.num_datapoints,
+                                   'header_bytes': paq.header_bytes})
+
+    return sidecar.cache_dir
+
+
+class PaqChannel():
+
+    def __init__(self, paq_file, chan_idx):
+        '''
+        Lazy view of a single channel of a PaqFile. Nothing is read from disk
+        until the channel is sliced. Channels read from the paq body are
+        byte-swapped into a native float32 array only for the requested
+        samples, channels with a sidecar are returned as read-only views of
+        the memory-mapped .npy
+
+        Inputs:
+        paq_file -- the PaqFile this channel belongs to
+        chan_idx -- index of the channel in paq_file.chan_names
+        '''
+
+        self.name = paq_file.chan_names[chan_idx]
+        self.unit = paq_file.units[chan_idx]
+        self.rate = paq_file.rate
+        self._view = paq_file._channel_view(chan_idx)
+
+    def __len__(self):
+        return self._view.shape[0]
+
+    @property
+    def shape(self):
+        return self._view.shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        data = self._view[key]
+        if isinstance(data, np.ndarray):
+            return np.asarray(data, dtype=np.float32)
+        return np.float32(data)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+
+class PaqFile():
+
+    def __init__(self, file_path, make_sidecar=False):
+        '''
+        Memory-mapped PAQ file (from PackIO). The header is parsed once and
+        the interleaved body is left on disk, so opening an hour long paq
+        is near instant and only the samples that are sliced are read
+
+        Inputs:
+        file_path    -- full path to the .paq file
+        make_sidecar -- decode the channels to a native-endian sidecar
+                        (paq_to_sidecar) if there is not a valid one already
+
+        Attributes:
+        chan_names, hw_chans, units, rate -- as returned by paq_read
+        num_datapoints -- number of samples in each channel
+        data -- lazy chans x samples big-endian view of the body, indexing
+                this directly does not byte-swap, use channel() for that
+
+        Can be indexed like the dict returned by paq_read, so a PaqFile can
+        be passed anywhere a paq is expected (e.g. utils_funcs.paq_data)
+        '''
+
+        self.file_path = file_path
+        self.sidecar = SidecarCache(file_path)
+
+        header = self.sidecar.load_json(PAQ_HEADER)
+
+        if header is None:
+            with open(file_path, 'rb') as fid:
+                self.rate, self.chan_names, self.hw_chans, self.units = \
+                    _read_paq_header(fid)
+                self.header_bytes = fid.tell()
+            num_chans = len(self.chan_names)
+            body_bytes = os.path.getsize(file_path) - self.header_bytes
+            self.num_datapoints = int(body_bytes / (4 * num_chans))
+        else:
+            self.rate = header['rate']
+            self.chan_names = header['chan_names']
+            self.hw_chans = header['hw_chans']
+            self.units = header['units']
+            self.header_bytes = header['header_bytes']
+            self.num_datapoints = header['num_datapoints']
+
+        self._body = np.memmap(file_path, dtype='>f', mode='r',
+                               offset=self.header_bytes,
+                               shape=(self.num_datapoints,
+                                      len(self.chan_names)))
+
+        self.has_sidecar = header is not None
+
+        if make_sidecar and not self.has_sidecar:
+            try:
+                print('Writing paq sidecar to {}'
+                      .format(paq_to_sidecar(self)))
+                self.has_sidecar = True
+            except OSError as e:
+                print('Could not write paq sidecar: {}'.format(e))
+
+    def _channel_view(self, chan_idx):
+        '''the sidecar memmap of a channel if there is one, otherwise
+           a strided view into the paq body'''
+        if self.has_sidecar:
+            chan = self.sidecar.load_array(_chan_file(chan_idx))
+            if chan is not None:
+                return chan
+        return self._body[:, chan_idx]
+
+    @property
+    def data(self):
+        return self._body.T
+
+    def channel(self, chan_name):
+        '''returns a lazy PaqChannel view of channel chan_name'''
+        return PaqChannel(self, self.chan_names.index(chan_name))
+
+    def pyramid(self, chan_name, factor=16):
+        '''returns the cached min/max pyramid of chan_name (paq_pyramid)'''
+        return paq_pyramid(self, chan_name, factor=factor)
+
+    def plot(self, chan_names=None):
+        '''level-of-detail plot of chan_names (default all channels)'''
+        import matplotlib.pyplot as plt
+
+        if chan_names is None:
+            chan_names = self.chan_names
+
+        f, axes = plt.subplots(len(chan_names), 1, sharex=True, squeeze=False)
+        for chan_name, ax in zip(chan_names, axes[:, 0]):
+            plot_envelope(ax, self.pyramid(chan_name),
+                          signal=self.channel(chan_name))
+            ax.set_ylabel(self.units[self.chan_names.index(chan_name)])
+            ax.set_title(chan_name)
+        plt.show()
+
+    def __getitem__(self, key):
+        if key not in PAQ_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in PAQ_KEYS
+
+
+class PaqSessionChannel():
+
+    def __init__(self, channels, offsets):
+        '''
+        Lazy view of one channel across the files of a PaqSession, indexed
+        on the session's continuous sample axis. Slices spanning a file
+        boundary are read from each file and joined, nothing else is copied
+
+        Inputs:
+        channels -- PaqChannel of this channel in each file, in order
+        offsets  -- session sample at which each file starts, plus the total
+        '''
+
+        self.name = channels[0].name
+        self.unit = channels[0].unit
+        self.rate = channels[0].rate
+        self._channels = channels
+        self._offsets = offsets
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step < 0:
+                return self[stop+1:start+1][::-1][::-step]
+            parts = []
+            for chan, offset in zip(self._channels, self._offsets):
+                chan_start = max(start - offset, 0)
+                chan_stop = min(stop - offset, len(chan))
+                if chan_start < chan_stop:
+                    parts.append(chan[chan_start:chan_stop])
+            if not parts:
+                return np.array([], dtype=np.float32)
+            return np.concatenate(parts)[::step]
+
+        if np.ndim(key) > 0:
+            key = np.asarray(key)
+            file_idx = np.searchsorted(self._offsets, key, side='right') - 1
+            data = np.empty(key.shape, dtype=np.float32)
+            for i in np.unique(file_idx):
+                in_file = file_idx == i
+                data[in_file] = self._channels[i][key[in_file]
+                                                  - self._offsets[i]]
+            return data
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('sample {} out of range'.format(key))
+        file_idx = np.searchsorted(self._offsets, key, side='right') - 1
+        return self._channels[file_idx][key - self._offsets[file_idx]]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+
+class PaqSession():
+
+    def __init__(self, file_paths, make_sidecar=False):
+        '''
+        Several paq files from a session that was stopped and restarted,
+        stitched into one continuous virtual sample axis. Each file is a
+        memory-mapped PaqFile, nothing is concatenated in memory
+
+        Inputs:
+        file_paths   -- paths to the .paq files in recording order
+        make_sidecar -- passed to each PaqFile
+
+        Attributes:
+        files   -- the PaqFile of each path
+        offsets -- session sample at which each file starts, the last
+                   element is the total number of samples
+        chan_names, hw_chans, units, rate -- shared by all files
+
+        Can be passed to utils_funcs.paq_data and paq_digital_edges as a paq,
+        samples and edges are on the session axis
+        '''
+
+        self.file_paths = list(file_paths)
+        self.files = [PaqFile(file_path, make_sidecar=make_sidecar)
+                      for file_path in self.file_paths]
+
+        first = self.files[0]
+        for paq in self.files[1:]:
+            assert paq.chan_names == first.chan_names and \
+                paq.rate == first.rate, \
+                '{} does not have the same channels and rate as {}'.format(
+                    paq.file_path, first.file_path)
+
+        self.chan_names = first.chan_names
+        self.hw_chans = first.hw_chans
+        self.units = first.units
+        self.rate = first.rate
+
+        self.offsets = np.cumsum([0] + [paq.num_datapoints
+                                        for paq in self.files])
+        self.num_datapoints = int(self.offsets[-1])
+
+    def channel(self, chan_name):
+        '''returns a lazy PaqSessionChannel view of chan_name'''
+        return PaqSessionChannel([paq.channel(chan_name)
+                                  for paq in self.files], self.offsets)
+
+    def file_sample(self, sample):
+        '''converts a session sample to (file index, sample in that file)'''
+        file_idx = int(np.searchsorted(self.offsets, sample, side='right') - 1)
+        return file_idx, sample - self.offsets[file_idx]
+
+    def digital_edges(self, chan_names, thresholds=1, chunk_size=2**20):
+        '''
+        paq_digital_edges of each file (cached per file) on the session axis.
+        A signal that is already high when a file starts only gives an edge
+        if it was low at the end of the previous file, as if the files had
+        been recorded as one
+        '''
+
+        if np.isscalar(thresholds):
+            thresholds = [thresholds] * len(chan_names)
+
+        file_edges = [paq_digital_edges(paq, chan_names, thresholds,
+                                        chunk_size) for paq in self.files]
+
+        edges = {}
+        for chan_name, threshold in zip(chan_names, thresholds):
+            chan_edges = []
+            prev_high = False
+            for paq, offset, paq_edges in zip(self.files, self.offsets,
+                                              file_edges):
+                if paq.num_datapoints == 0:
+                    continue
+                this_edges = paq_edges[chan_name]
+                if prev_high and len(this_edges) and this_edges[0] == 0:
+                    this_edges = this_edges[1:]
+                chan_edges.append(this_edges + offset)
+                prev_high = paq.channel(chan_name)[-1] > threshold
+            if chan_edges:
+                edges[chan_name] = np.concatenate(chan_edges).astype(np.int64)
+            else:
+                edges[chan_name] = np.array([], dtype=np.int64)
+
+        return edges
+
+    def __getitem__(self, key):
+        if key == 'data':
+            raise KeyError('PaqSession has no data array, use channel()')
+        if key not in PAQ_KEYS:
+            raise KeyError(key)
+        if key == 'file_path':
+            return None
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in PAQ_KEYS and key not in ('data', 'file_path')
+
+
+def open_paq(file_path, make_sidecar=False):
+    '''PaqFile for a single path or PaqSession for a list of paths'''
+    if isinstance(file_path, (list, tuple)):
+        if len(file_path) == 1:
+            return PaqFile(file_path[0], make_sidecar=make_sidecar)
+        return PaqSession(file_path, make_sidecar=make_sidecar)
+    return PaqFile(file_path, make_sidecar=make_sidecar)
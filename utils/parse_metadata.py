@@ -1,86 +1,420 @@
+import functools
+
 from utils.gsheets_importer import path_finder
+from utils.metadata_store import default_store
+
+# number of PVStateShard indexes kept by loadPVStateShard
+SHARD_CACHE_SIZE = 64
+
 
 def getPVStateShard(path, key):
     
+    # the shard is indexed once per file, later keys are dictionary lookups
+    return loadPVStateShard(path).get(key)
+
+
+def loadPVStateShard(path):
+    '''
+    PVStateShard index of the top level PVStateShard of the xml at path. Only
+    the start of the file is read, parsing stops once the shard is complete. 
+    The last SHARD_CACHE_SIZE indexes are kept, keyed on the file's size and 
+    mtime, so repeated calls do not read an unchanged file again
+    '''
+    
+    import os
+    
+    stat = os.stat(path)
+    return _parsePVStateShard(os.path.abspath(path), stat.st_size, 
+                              stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=SHARD_CACHE_SIZE)
+def _parsePVStateShard(path, size, mtime_ns):
+    # size and mtime_ns are only part of the cache key
+    
     import xml.etree.ElementTree as ET
     
+    shard = None
+    depth = 0
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if elem.tag == 'PVStateShard' and depth == 1:
+            shard = PVStateShard(elem)
+            break
+        
+    if shard is None:
+        raise Exception('ERROR: no PVStateShard in {}'.format(path))
+        
+    return shard
+
+
+class PVStateShard():
+    
+    def __init__(self, shard_elem):
+        '''
+        Index of the PVStateValue elements of a PVStateShard element, built 
+        in one pass so each key is a dictionary lookup rather than a scan of 
+        the shard. Gives the same results as scanning the shard for each key:
+        a key's own element gives its value (or lists of the value, 
+        description and index of its entries), and a key found on a 
+        subelement gives the value of the element it is in. The first match 
+        in the shard wins
+        
+        Inputs:
+            shard_elem - PVStateShard element, or None for an empty shard
+        '''
+        
+        self._index = {}
+        
+        if shard_elem is None:
+            return
+        
+        for elem in shard_elem:
+            entry = _readShardValue(elem)
+            if entry[0] or len(elem) == 0:
+                self._index.setdefault(elem.get('key'), entry)
+            
+            for subelem in elem: # keys on subelements
+                sub_key = subelem.get('key')
+                if sub_key is not None and elem.get('value'):
+                    self._index.setdefault(sub_key, (elem.get('value'), [], []))
+                    
+    @classmethod
+    def from_element(cls, elem):
+        '''index of the PVStateShard child of elem (e.g. the xml root or a 
+           Frame)'''
+        return cls(elem.find('PVStateShard'))
+    
+    def get(self, key):
+        '''
+        Outputs:
+            value       - value of the key
+            description - descriptions of the key's entries
+            index       - index of each of the key's entries
+        '''
+        
+        entry = self._index.get(key)
+        if entry is None or not entry[0]: # if no value found at all, raise exception
+            raise Exception('ERROR: no element or subelement with that key')
+            
+        return entry
+    
+    def __getitem__(self, key):
+        return self.get(key)
+    
+    def __contains__(self, key):
+        entry = self._index.get(key)
+        return entry is not None and bool(entry[0])
+    
+    def keys(self):
+        return self._index.keys()
+    
+    def to_dict(self):
+        '''json serialisable form of the index, see from_dict'''
+        return {key: list(entry) for key, entry in self._index.items()}
+    
+    @classmethod
+    def from_dict(cls, index):
+        shard = cls(None)
+        shard._index = {key: tuple(entry) for key, entry in index.items()}
+        return shard
+
+
+def _readShardValue(elem):
+    '''value, description, index of a PVStateValue element, in the same
+       form as getPVStateShard returns them'''
+    
+    if len(elem) == 0: # single value
+        return elem.get('value'), [], []
+    
     value = []
     description = []
     index = []
+    for subelem in elem: # lots of entries for that key
+        value.append(subelem.get('value'))
+        description.append(subelem.get('description'))
+        index.append(subelem.get('index'))
+        
+    return value, description, index
+
+
+def scanPVxml(path):
+    '''
+    Reads everything needed from a PrairieView xml in a single streaming pass,
+    clearing each Frame once it has been read so memory does not grow with 
+    the number of frames
+    
+    Returns dict with:
+        shard            -- PVStateShard index of the top level shard
+        acq_type         -- type of the first Sequence
+        n_sequences      -- number of Sequence elements
+        n_seq_frames     -- number of Frames in the first Sequence
+        last_cycle       -- cycle of the last Sequence
+        last_frame_index -- index of the last Frame
+        last_frame_shard -- PVStateShard index of the last Frame
+        last_good_frame  -- lastGoodFrame of the first Frame's ExtraParameters
+    '''
+    
+    import xml.etree.ElementTree as ET
+    
+    meta = {'shard': None, 'acq_type': None, 'n_sequences': 0, 
+            'n_seq_frames': 0, 'last_cycle': None, 'last_frame_index': None,
+            'last_frame_shard': PVStateShard(None), 'last_good_frame': None}
+    
+    elems = [] # open elements, root first
+    frame_shard = None
     
-    xml_tree = ET.parse(path) # parse xml from a path
-    root = xml_tree.getroot() # make xml tree structure
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        
+        if event == 'start':
+            elems.append(elem)
+            
+            if elem.tag == 'Sequence' and len(elems) == 2:
+                meta['n_sequences'] += 1
+                meta['last_cycle'] = elem.get('cycle')
+                if meta['n_sequences'] == 1:
+                    meta['acq_type'] = elem.get('type')
+                    
+            elif elem.tag == 'Frame' and len(elems) == 3:
+                frame_shard = None
+                meta['last_frame_index'] = elem.get('index')
+                if meta['n_sequences'] == 1:
+                    meta['n_seq_frames'] += 1
+            continue
+        
+        elems.pop()
+        
+        if elem.tag == 'PVStateShard':
+            if len(elems) == 1 and meta['shard'] is None: # top level shard
+                meta['shard'] = PVStateShard(elem)
+            elif elems[-1].tag == 'Frame':
+                frame_shard = PVStateShard(elem)
+                
+        elif elem.tag == 'ExtraParameters' and elems[-1].tag == 'Frame' and \
+             meta['last_good_frame'] is None:
+            meta['last_good_frame'] = elem.get('lastGoodFrame')
+            
+        elif elem.tag in ('Frame', 'Sequence') and elems:
+            if elem.tag == 'Frame':
+                meta['last_frame_shard'] = PVStateShard(None) if frame_shard is None else frame_shard
+            elems[-1].remove(elem) # drop the parsed element from the tree
+            
+    return meta
 
-    pv_state_shard = root.find('PVStateShard') # find pv state shard element in root
 
-    for elem in pv_state_shard: # for each element in pv state shard, find the value for the specified key
+def scanPVframeTimes(path):
+    '''
+    Times of every Frame of a PrairieView xml in a single streaming pass, 
+    only the Frame attributes are read and each Frame is dropped once read
+    so 100k frame files parse in constant memory
+    
+    Returns structured array with one row per Frame and fields:
+        relative_time -- relativeTime (s) of the frame
+        absolute_time -- absoluteTime (s) of the frame
+        plane         -- plane of the frame in a ZSeries, 0 otherwise
+        cycle         -- Sequence the frame belongs to, from 0
+    '''
+    
+    import numpy as np
+    from array import array
+    import xml.etree.ElementTree as ET
+    
+    relative_time = array('d')
+    absolute_time = array('d')
+    plane = array('i')
+    cycle = array('i')
+    
+    elems = [] # open elements, root first
+    zseries = None
+    n_sequences = 0
+    seq_frame = 0
+    
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
         
-        if elem.get('key') == key: 
+        if event == 'start':
+            elems.append(elem)
             
-            if len(elem) == 0: # if the element has only one subelement
-                value = elem.get('value')
-                break
+            if elem.tag == 'Sequence' and len(elems) == 2:
+                if zseries is None:
+                    zseries = 'ZSeries' in elem.get('type', '')
+                n_sequences += 1
+                seq_frame = 0
                 
-            else: # if the element has many subelements (i.e. lots of entries for that key)
-                for subelem in elem:
-                    value.append(subelem.get('value'))
-                    description.append(subelem.get('description'))
-                    index.append(subelem.get('index'))
-        else:
-            for subelem in elem: # if key not in element, try subelements
-                if subelem.get('key') == key:
-                    value = elem.get('value')
-                    break
-                    
-        if value: # if found key in subelement, break the loop
-            break
+            elif elem.tag == 'Frame' and len(elems) == 3:
+                relative_time.append(float(elem.get('relativeTime')))
+                absolute_time.append(float(elem.get('absoluteTime')))
+                plane.append(seq_frame if zseries else 0)
+                cycle.append(n_sequences - 1)
+                seq_frame += 1
+            continue
+        
+        elems.pop()
+        if elem.tag in ('Frame', 'Sequence') and elems:
+            elems[-1].remove(elem) # drop the parsed element from the tree
             
-    if not value: # if no value found at all, raise exception
-        raise Exception('ERROR: no element or subelement with that key')
+    times = np.zeros(len(relative_time), dtype=[('relative_time', np.float64),
+                                                 ('absolute_time', np.float64),
+                                                 ('plane', np.int32),
+                                                 ('cycle', np.int32)])
+    times['relative_time'] = np.frombuffer(relative_time, dtype=np.float64)
+    times['absolute_time'] = np.frombuffer(absolute_time, dtype=np.float64)
+    times['plane'] = np.frombuffer(plane, dtype=np.intc)
+    times['cycle'] = np.frombuffer(cycle, dtype=np.intc)
     
-    return value, description, index
+    return times
+
+
+def readPVframeTimes(path, plane=None, use_cache=True):
+    '''
+    scanPVframeTimes of path, cached as frame_times.npy in a sidecar next to
+    the xml so later calls read the array rather than the xml
+    
+    Inputs:
+        path      - path to PrairieView xml
+        plane     - only return the frames of this plane
+        use_cache - load / save the sidecar
+    '''
+    
+    from utils.file_cache import SidecarCache
+    
+    times = None
+    cache = None
+    if use_cache:
+        try:
+            cache = SidecarCache(path)
+            times = cache.load_array('frame_times.npy')
+        except OSError:
+            cache = None
+            
+    if times is None:
+        times = scanPVframeTimes(path)
+        if cache is not None:
+            try:
+                cache.save_array('frame_times.npy', times)
+            except OSError as e:
+                print('Could not cache frame times of {}: {}'.format(path, e))
+                
+    if plane is not None:
+        times = times[times['plane'] == plane]
+        
+    return times
+
+
+def _scanPVxmlJson(path):
+    '''scanPVxml with the shards in json serialisable form, for the store'''
+    
+    meta = scanPVxml(path)
+    for key in ('shard', 'last_frame_shard'):
+        if meta[key] is not None:
+            meta[key] = meta[key].to_dict()
+            
+    return meta
 
 
-def parsePVxml(path):
+def readPVxmls(paths):
+    '''
+    scanPVxml of each of paths, read from the local metadata store for files 
+    that have not changed since they were last scanned (one query for all
+    of them) and scanned and stored otherwise
+    '''
+    
+    metas = []
+    # repeated paths share one stored value, so each gets its own copy
+    for stored in default_store().lookup_many('pv', paths, _scanPVxmlJson):
+        meta = dict(stored)
+        for key in ('shard', 'last_frame_shard'):
+            if meta[key] is not None:
+                meta[key] = PVStateShard.from_dict(meta[key])
+        metas.append(meta)
+                
+    return metas
+
+
+def readPVxml(path):
+    '''scanPVxml of path through the local metadata store'''
+    return readPVxmls([path])[0]
+
+
+def _readNAPARMxml(path):
+    
+    import xml.etree.ElementTree as ET
+    
+    root = ET.parse(path).getroot()
+    
+    return {'name': root.get('Name'), 
+            'iterations': root.get('Iterations'),
+            'elems': [dict(elem.attrib) for elem in root],
+            'first_points': [dict(elem[0].attrib) if len(elem) else {} for elem in root]}
+
+
+def readNAPARMxmls(paths):
+    '''
+    Attributes of a NAPARM xml needed for its metadata, through the local
+    metadata store. Returns dict for each of paths with:
+        name         -- Name of the root (e.g. '10Groups_2Reps_5Shots')
+        iterations   -- Iterations of the root
+        elems        -- attributes of each element of the root
+        first_points -- attributes of the first point of each element
+    '''
+    return default_store().lookup_many('naparm_xml', paths, _readNAPARMxml)
+
+
+def _readNAPARMgpl(path):
     
     import xml.etree.ElementTree as ET
     
-    xml_tree = ET.parse(path) # parse xml from a path
-    root = xml_tree.getroot() # make xml tree structure
+    root = ET.parse(path).getroot()
+    
+    return [dict(elem.attrib) for elem in root]
+
+
+def readNAPARMgpls(paths):
+    '''attributes of each point of each NAPARM gpl in paths, through the
+       local metadata store'''
+    return default_store().lookup_many('naparm_gpl', paths, _readNAPARMgpl)
+
 
-    sequence = root.find('Sequence')
-    acq_type = sequence.get('type')
+def parsePVxml(path, meta=None):
+    
+    if meta is None:
+        meta = readPVxml(path) # single pass over the xml, or the stored scan
+    shard = meta['shard'] if meta['shard'] is not None else PVStateShard(None)
+    
+    acq_type = meta['acq_type']
 
     if 'ZSeries' in acq_type:
-        n_planes = len(sequence.findall('Frame'))
-        n_sequences = len(root.findall('Sequence'))
+        n_planes = meta['n_seq_frames']
+        n_sequences = meta['n_sequences']
         n_frames = n_sequences * n_planes
 
     else:
         n_planes = 1
-        n_frames = len(sequence.findall('Frame'))
+        n_frames = meta['n_seq_frames']
     print('Number of frames:', n_frames, '\nNumber of planes:', n_planes)
     
-    frame_period = float(getPVStateShard(path,'framePeriod')[0])
+    frame_period = float(shard.get('framePeriod')[0])
     fps = 1/frame_period
     print('Frames per second:', fps)
 
-    frame_avg = int(getPVStateShard(path,'rastersPerFrame')[0])
+    frame_avg = int(shard.get('rastersPerFrame')[0])
     print('Frame averaging:', frame_avg)
 
-    pixels_per_line = int(getPVStateShard(path,'pixelsPerLine')[0])
+    pixels_per_line = int(shard.get('pixelsPerLine')[0])
     print('Size (x):', pixels_per_line)
 
-    lines_per_frame = int(getPVStateShard(path,'linesPerFrame')[0])
+    lines_per_frame = int(shard.get('linesPerFrame')[0])
     print('Size (y):', lines_per_frame)
 
-    laser_powers, lasers, _ = getPVStateShard(path,'laserPower')
+    laser_powers, lasers, _ = shard.get('laserPower')
     for power,laser in zip(laser_powers,lasers):
         if laser == 'Imaging':
             imaging_power = float(power)
     print('Imaging laser power:', imaging_power)
     
-    pixelSize, _, index = getPVStateShard(path,'micronsPerPixel')
+    pixelSize, _, index = shard.get('micronsPerPixel')
     for pixelSize,index in zip(pixelSize,index):
         if index == 'XAxis':
             pixelSizeX = float(pixelSize)
@@ -91,19 +425,17 @@ def parsePVxml(path):
     return fps, frame_avg, pixels_per_line, lines_per_frame, imaging_power, n_planes, n_frames, pixelSizeX, pixelSizeY
 
 
-def parseNAPARMxml(path):
+def parseNAPARMxml(path, meta=None):
     
-    import xml.etree.ElementTree as ET  
-
-    xml_tree = ET.parse(path)
-    root = xml_tree.getroot()
+    if meta is None:
+        meta = readNAPARMxmls([path])[0]
 
-    title = root.get('Name')
-    n_trials = int(root.get('Iterations'))
+    title = meta['name']
+    n_trials = int(meta['iterations'])
 
-    for elem in root:
-        if int(elem[0].get('InitialDelay')) > 0:
-            inter_point_delay = int(elem[0].get('InitialDelay'))
+    for point in meta['first_points']:
+        if int(point.get('InitialDelay')) > 0:
+            inter_point_delay = int(point.get('InitialDelay'))
 
     import re 
 
@@ -111,23 +443,21 @@ def parseNAPARMxml(path):
 
     print('Number of groups:', n_groups, '\nNumber of sequence reps:', n_reps, '\nNumber of shots:', n_shots, '\nNumbers of trials:', n_trials, '\nInter-point delay:', inter_point_delay)
     
-    repetitions = int(root[1].get('Repetitions'))
+    repetitions = int(meta['elems'][1].get('Repetitions'))
     print('Repetitions:', repetitions)
     
     return n_groups, n_reps, n_shots, n_trials, inter_point_delay, repetitions
 
 
-def parseNAPARMgpl(path):
+def parseNAPARMgpl(path, points=None):
     
-    import xml.etree.ElementTree as ET
-    
-    xml_tree = ET.parse(path)
-    root = xml_tree.getroot()
+    if points is None:
+        points = readNAPARMgpls([path])[0]
 
-    for elem in root:
-        if elem.get('Duration'):
-            single_stim_dur = float(elem.get('Duration'))
-            print('Single stim dur (ms):', elem.get('Duration'))
+    for point in points:
+        if point.get('Duration'):
+            single_stim_dur = float(point.get('Duration'))
+            print('Single stim dur (ms):', point.get('Duration'))
             break
 
     return single_stim_dur
@@ -140,6 +470,9 @@ def getMetadata(tiffs_pstation, naparm_pstation):
     pv_values = []
     naparm_xml = []
     naparm_gpl = []
+    pv_paths = []
+    naparm_xml_paths = []
+    naparm_gpl_paths = []
 
     for tiff_path, naparm_path in zip(tiffs_pstation, naparm_pstation):
         print(tiff_path)
@@ -168,9 +501,18 @@ def getMetadata(tiffs_pstation, naparm_pstation):
         print(NAPARM_gpl_path)
         
         if(tiff_path):
-            pv_values.append(parsePVxml(PV_xml_path))
+            pv_paths.append(PV_xml_path)
         if(naparm_path):
-            naparm_xml.append(parseNAPARMxml(NAPARM_xml_path))
-            naparm_gpl.append(parseNAPARMgpl(NAPARM_gpl_path))
+            naparm_xml_paths.append(NAPARM_xml_path)
+            naparm_gpl_paths.append(NAPARM_gpl_path)
+    
+    # read every file through the metadata store at once, only files that
+    # changed since they were last read are parsed
+    for path, meta in zip(pv_paths, readPVxmls(pv_paths)):
+        pv_values.append(parsePVxml(path, meta))
+    for path, meta in zip(naparm_xml_paths, readNAPARMxmls(naparm_xml_paths)):
+        naparm_xml.append(parseNAPARMxml(path, meta))
+    for path, points in zip(naparm_gpl_paths, readNAPARMgpls(naparm_gpl_paths)):
+        naparm_gpl.append(parseNAPARMgpl(path, points))
 
     return pv_values, naparm_xml, naparm_gpl
\ No newline at end of file
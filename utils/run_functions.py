@@ -6,6 +6,7 @@ import seaborn as sns
 from scipy import signal
 from subsets_analysis import Subsets
 import utils_funcs as utils
+from local_cache import local_path
 from scipy import signal
 import random
 import copy
@@ -623,6 +624,8 @@ class GetTargets():
                 group = {}
                 
                 mat_path = os.path.join(blimp_path, folder, 'matlab_input_parameters.mat')
+                # read from the local cache, staged there the first time
+                mat_path = local_path(mat_path, stage=True)
                 loadmat = utils.LoadMat(mat_path)
                 #mat = loadmat(mat_path)
                 mat = loadmat.dict_
@@ -0,0 +1,209 @@
+'''
+Consolidation of PrairieView single page .ome tiffs into one multipage tiff
+
+PrairieView writes every frame of a tseries as its own .ome.tif. These are
+read on a process pool and written into a single contiguous BigTIFF that
+suite2p, cacher.tiff_metadata and movie_source.TiffMovie can all read (the
+latter by memory-map). Progress is recorded next to the output so an
+interrupted conversion carries on where it stopped, and the single page
+tiffs are only deleted once the consolidated tiff has been checked against
+the frame count in the PrairieView xml.
+'''
+
+import os
+import glob
+import json
+import numpy as np
+import tifffile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def single_page_tiffs(tseries_folder, channel='Ch3'):
+    '''sorted paths of the single page .ome tiffs of channel in
+       tseries_folder (PrairieView zero-pads the frame numbers)'''
+    return sorted(glob.glob(os.path.join(tseries_folder,
+                                         '*{}*.ome.tif'.format(channel))))
+
+
+def xml_frame_count(xml_path, channel='Ch3'):
+    '''
+    Number of frames of channel listed in a PrairieView xml, counted from
+    the File elements of every Frame in a single streaming pass
+    '''
+
+    n_frames = 0
+    for _, elem in ET.iterparse(xml_path):
+        if elem.tag == 'File' and channel in elem.get('filename', ''):
+            n_frames += 1
+        elif elem.tag == 'Frame':
+            elem.clear()
+
+    return n_frames
+
+
+def _write_chunk(output_path, tiff_paths, start):
+    '''process pool worker, copies tiff_paths into frames start onwards of
+       the consolidated tiff'''
+
+    movie = tifffile.memmap(output_path, mode='r+')
+    for i, tiff_path in enumerate(tiff_paths):
+        movie[start + i] = tifffile.imread(tiff_path)
+    movie.flush()
+    del movie
+
+    return start
+
+
+def _load_progress(progress_path):
+    try:
+        with open(progress_path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _save_progress(progress_path, progress):
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+
+def _delete_originals(output_path, tiff_paths, frame_names):
+    '''
+    Deletes single page tiffs once every one of them has been checked
+    against its frame of the verified output. frame_names are the names of
+    the single page tiffs in frame order when the output was made, so the
+    ones left after an interrupted delete still find their frames
+    '''
+
+    frame_of = {name: i for i, name in enumerate(frame_names)}
+    movie = tifffile.memmap(output_path, mode='r')
+
+    for tiff_path in tiff_paths:
+        frame = frame_of.get(os.path.basename(tiff_path))
+        assert frame is not None and frame < movie.shape[0], \
+            '{} is not a frame of {}, not deleting it'.format(tiff_path,
+                                                             output_path)
+        assert np.array_equal(movie[frame], tifffile.imread(tiff_path)), \
+            'frame {} of {} does not match {}, not deleting it'.format(
+                frame, output_path, tiff_path)
+    del movie
+
+    for tiff_path in tiff_paths:
+        os.remove(tiff_path)
+
+
+def consolidation_verified(output_path):
+    '''True if output_path is a consolidated tiff that has been verified
+       against its single page tiffs and xml'''
+    progress = _load_progress(output_path + '.progress.json')
+    return bool(progress and progress.get('verified')) and \
+        os.path.exists(output_path)
+
+
+def consolidate_tseries(tseries_folder, channel='Ch3', xml_path=None,
+                        output_path=None, processes=None, chunk_size=256,
+                        delete=False):
+    '''
+    Converts the single page .ome tiffs of one channel of a tseries into a
+    single contiguous multipage BigTIFF
+
+    Inputs:
+    tseries_folder -- folder holding the single page tiffs and PV xml
+    channel        -- channel string in the tiff names, e.g. 'Ch3'
+    xml_path       -- PrairieView xml of the tseries, the .xml named after
+                      the folder if None
+    output_path    -- consolidated tiff, <folder name>_<channel>.tif in the
+                      folder if None
+    processes      -- number of worker processes (default cpu count)
+    chunk_size     -- number of frames copied by each task
+    delete         -- delete the single page tiffs once the output has been
+                      verified against the xml and each of them against
+                      its frame of the output. If the output was already
+                      verified this finishes an interrupted delete
+
+    Returns path to the consolidated tiff
+    '''
+
+    tseries_name = os.path.basename(os.path.normpath(tseries_folder))
+    if xml_path is None:
+        xml_path = os.path.join(tseries_folder, tseries_name + '.xml')
+    if output_path is None:
+        output_path = os.path.join(tseries_folder, '{}_{}.tif'
+                                   .format(tseries_name, channel))
+    progress_path = output_path + '.progress.json'
+    # names of the single page tiffs in frame order, for deleting them later
+    names_path = output_path + '.frames.json'
+
+    tiff_paths = single_page_tiffs(tseries_folder, channel)
+    progress = _load_progress(progress_path)
+
+    if not tiff_paths and progress is None:
+        raise FileNotFoundError('no single page {} tiffs in {}'
+                                .format(channel, tseries_folder))
+
+    # a verified output is never rewritten, only the deletion of any
+    # originals left over from an interrupted run is finished
+    if progress is not None and progress.get('verified'):
+        if not os.path.exists(output_path):
+            raise FileNotFoundError('{} was verified but is missing, not '
+                                    'remaking it from the single page tiffs '
+                                    'left'.format(output_path))
+        if tiff_paths and delete:
+            _delete_originals(output_path, tiff_paths,
+                              _load_progress(names_path) or [])
+        return output_path
+
+    n_frames = len(tiff_paths)
+    chunk_starts = list(range(0, n_frames, chunk_size))
+
+    if progress is None or progress['n_frames'] != n_frames or \
+       not os.path.exists(output_path):
+
+        first = tifffile.imread(tiff_paths[0])
+        movie = tifffile.memmap(output_path, shape=(n_frames,) + first.shape,
+                                dtype=first.dtype, bigtiff=True,
+                                photometric='minisblack')
+        del movie
+        _save_progress(names_path, [os.path.basename(path)
+                                    for path in tiff_paths])
+        progress = {'n_frames': n_frames, 'done': [], 'verified': False}
+        _save_progress(progress_path, progress)
+
+    todo = [start for start in chunk_starts if start not in progress['done']]
+    print('Consolidating {} {} frames of {} ({} chunks to do)'
+          .format(n_frames, channel, tseries_name, len(todo)))
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(_write_chunk, output_path,
+                               tiff_paths[start:start+chunk_size], start)
+                   for start in todo]
+        for future in as_completed(futures):
+            progress['done'].append(future.result())
+            _save_progress(progress_path, progress)
+
+    # verify against the xml and spot check frames against the originals
+    xml_frames = xml_frame_count(xml_path, channel)
+    movie = tifffile.memmap(output_path, mode='r')
+    assert movie.shape[0] == n_frames == xml_frames, \
+        '{} has {} frames, {} single page tiffs, xml lists {}'.format(
+            output_path, movie.shape[0], n_frames, xml_frames)
+
+    for i in np.unique(np.linspace(0, n_frames - 1, 10).astype(int)):
+        assert np.array_equal(movie[i], tifffile.imread(tiff_paths[i])), \
+            'frame {} of {} does not match {}'.format(i, output_path,
+                                                      tiff_paths[i])
+    del movie
+
+    progress['verified'] = True
+    _save_progress(progress_path, progress)
+    print('Consolidated tiff verified: {}'.format(output_path))
+
+    if delete:
+        # every original is compared with its frame before any is deleted
+        _delete_originals(output_path, tiff_paths,
+                          [os.path.basename(path) for path in tiff_paths])
+
+    return output_path
@@ -0,0 +1,124 @@
+'''
+Fast tiff metadata (image dims, number of frames, channel) for tseries
+
+Only the first IFD of each tiff is read, and only the tags that are needed,
+so getting the metadata of a multi-GB tiff on the NAS costs a few small
+reads. Results are kept in the local metadata store against the file
+fingerprint, and tiffs_metadata looks up many tiffs with one query and fans
+the parsing of the rest out over a thread pool.
+'''
+
+import os
+import re
+import struct
+import tifffile
+
+try:
+    from utils.metadata_store import default_store
+except ModuleNotFoundError:
+    from metadata_store import default_store
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+IMAGE_DESCRIPTION = 270
+
+# tiff type code -> (struct format, bytes)
+TIFF_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4),
+              7: ('B', 1), 16: ('Q', 8)}
+
+def read_tiff_tags(tiff_path, tags=(IMAGE_WIDTH, IMAGE_LENGTH,
+                                    IMAGE_DESCRIPTION)):
+    '''
+    Returns {tag code: value} of tags in the first IFD of tiff_path, read
+    straight from the file without parsing any other tags or pages.
+    Handles classic and BigTIFF in either byte order
+    '''
+
+    values = {}
+    with open(tiff_path, 'rb') as f:
+        header = f.read(16)
+        bo = {b'II': '<', b'MM': '>'}[header[:2]]
+        version = struct.unpack(bo + 'H', header[2:4])[0]
+
+        if version == 42:
+            ifd_offset = struct.unpack(bo + 'I', header[4:8])[0]
+            count_fmt, entry_fmt, entry_size, inline_size = 'H', 'HHI', 12, 4
+        elif version == 43:
+            ifd_offset = struct.unpack(bo + 'Q', header[8:16])[0]
+            count_fmt, entry_fmt, entry_size, inline_size = 'Q', 'HHQ', 20, 8
+        else:
+            raise ValueError('{} is not a tiff'.format(tiff_path))
+
+        f.seek(ifd_offset)
+        count_size = struct.calcsize(count_fmt)
+        n_entries = struct.unpack(bo + count_fmt, f.read(count_size))[0]
+        entries = f.read(n_entries * entry_size)
+
+        for i in range(n_entries):
+            entry = entries[i*entry_size:(i+1)*entry_size]
+            code, dtype, count = struct.unpack(
+                bo + entry_fmt, entry[:entry_size - inline_size])
+            if code not in tags or dtype not in TIFF_TYPES:
+                continue
+
+            fmt, size = TIFF_TYPES[dtype]
+            data = entry[entry_size - inline_size:]
+            if count * size > inline_size:
+                offset = struct.unpack(bo + ('I' if inline_size == 4
+                                             else 'Q'), data)[0]
+                f.seek(offset)
+                data = f.read(count * size)
+
+            if dtype == 2:
+                values[code] = data[:count].rstrip(b'\x00').decode(
+                    'utf-8', errors='replace')
+            else:
+                value = struct.unpack(bo + fmt * count, data[:count * size])
+                values[code] = value[0] if count == 1 else value
+
+    return values
+
+
+def _read_tiff_info(tiff_path):
+    '''tiff_info of tiff_path read from the file'''
+
+    tags = read_tiff_tags(tiff_path)
+
+    n_frames = re.search(r'(?<=\[)(.*?)(?=\,)',
+                         tags.get(IMAGE_DESCRIPTION, ''))
+    if n_frames is not None:
+        n_frames = int(n_frames.group(0))
+    else:
+        # no shape in the description, fall back to counting pages
+        with tifffile.TiffFile(tiff_path) as tif:
+            n_frames = len(tif.pages)
+
+    channel = re.search(r'Ch\d', os.path.basename(tiff_path))
+
+    return {'dims': [tags[IMAGE_WIDTH], tags[IMAGE_LENGTH]],
+            'n_frames': n_frames,
+            'channel': channel.group(0) if channel else None}
+
+
+def tiff_info(tiff_path):
+    '''
+    Returns {'dims': [x, y], 'n_frames', 'channel'} of tiff_path. The
+    number of frames is taken from the shape in the ImageDescription, the
+    channel (e.g. 'Ch3', None if not known) from the file name
+    '''
+    return default_store().lookup('tiff', tiff_path, _read_tiff_info)
+
+
+def tiff_metadata(tiff_path):
+    '''returns the image dims [x, y] and number of frames of tiff_path'''
+    info = tiff_info(tiff_path)
+    return info['dims'], info['n_frames']
+
+
+def tiffs_metadata(tiff_paths, max_workers=8):
+    '''tiff_metadata of each of tiff_paths, the stored ones with one query
+       and the rest read on a thread pool so the network round trips
+       overlap. Returned in the order given'''
+    infos = default_store().lookup_many('tiff', tiff_paths, _read_tiff_info,
+                                        max_workers=max_workers)
+    return [(info['dims'], info['n_frames']) for info in infos]
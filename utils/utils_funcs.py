@@ -10,6 +10,10 @@ import bisect
 import copy
 from scipy import stats
 import scipy.io as spio
+try:
+    from utils.paq2py import paq_edges, paq_digital_edges, minmax_pyramid
+except ModuleNotFoundError:
+    from paq2py import paq_edges, paq_digital_edges, minmax_pyramid
 
 # global plotting params
 params = {'legend.fontsize': 'x-large',
@@ -182,14 +186,21 @@ def d_prime(hit_rate, false_alarm_rate):
 
 def paq_data(paq, chan_name, threshold_ttl=False, plot=False):
     '''
-    returns the data in paq (from paq_read) from channel: chan_names
-    if threshold_tll: returns sample that trigger occured on
+    returns the data in paq (from paq_read or a PaqFile) from channel: chan_names
+    if threshold_tll: returns sample that trigger occured on, cached
+    per paq file so only the first call touches the analog data
     '''
 
-    chan_idx = paq['chan_names'].index(chan_name)
-    data = paq['data'][chan_idx, :]
     if threshold_ttl:
-        data = threshold_detect(data, 1)
+        # streamed and cached against the paq file (see paq2py.paq_edges)
+        data = paq_edges(paq, chan_name, threshold=1)
+    elif hasattr(paq, 'channel'):
+        # PaqFile, only this channel is read from disk. Sidecar channels
+        # are read-only memmaps, copy so callers can modify the data
+        data = np.require(paq.channel(chan_name)[:], requirements='W')
+    else:
+        chan_idx = paq['chan_names'].index(chan_name)
+        data = paq['data'][chan_idx, :]
 
     if plot:
         if threshold_ttl:
@@ -285,8 +296,9 @@ def stim_start_frame(paq=None, stim_chan_name=None, frame_clock=None,
     '''
 
     if frame_clock is None:
-        frame_clock = paq_data(paq, 'frame_clock', threshold_ttl=True)
-        stim_times = paq_data(paq, stim_chan_name, threshold_ttl=True)
+        edges = paq_digital_edges(paq, ['frame_clock', stim_chan_name])
+        frame_clock = edges['frame_clock']
+        stim_times = edges[stim_chan_name]
 
     stim_times = [stim for stim in stim_times if stim < np.nanmax(frame_clock)]
 
@@ -384,6 +396,68 @@ def tseries_finder(tseries_lens, frame_clock, paq_rate=20000):
     return frame_clock[real_idx]
 
 
+def tseries_clock_match(frame_times, frame_clock, paq_rate=20000,
+                        tolerance=None):
+
+    ''' Finds the chunk of frame clock that corresponds to a tseries from
+        the frame times PrairieView recorded for it, a check on
+        tseries_finder that does not need to guess at the number of
+        foxy extra frames
+        frame_times -- relativeTime (s) of each frame of the tseries
+                       (parse_metadata.readPVframeTimes)
+        frame_clock -- thresholded times each frame recorded in paqio occured
+        paq_rate    -- input sampling rate of paqio
+        tolerance   -- largest difference (s) allowed between the clock and
+                       frame_times, half the median frame period if None
+
+        returns
+        tseries_clock -- frame_clock edges of the tseries frames, None if
+                         the clock is shorter than the tseries
+        max_error     -- largest difference (s) between the clock and
+                         frame_times once clock drift is fit out
+        matched       -- max_error is within tolerance
+
+        raises ValueError if there are fewer than 2 frame times or clock
+        edges, there is no frame period or drift to fit
+
+        '''
+
+    frame_times = np.asarray(frame_times, dtype=np.float64)
+    frame_clock = np.asarray(frame_clock)
+    if len(frame_times) < 2 or len(frame_clock) < 2:
+        raise ValueError('need at least 2 frame times and clock edges to '
+                         'match, got {} and {}'.format(len(frame_times),
+                                                       len(frame_clock)))
+
+    frame_times = frame_times - frame_times[0]
+    clock = frame_clock / paq_rate
+    n_frames = len(frame_times)
+
+    if tolerance is None:
+        tolerance = np.median(np.diff(frame_times)) / 2
+
+    # a tseries starts the clock after a gap of more than 1s, as in
+    # tseries_finder
+    starts = np.concatenate([[0], np.where(np.diff(clock) > 1)[0] + 1])
+    starts = starts[starts + n_frames <= len(clock)]
+
+    best_start, max_error = None, np.inf
+    for start in starts:
+        chunk = clock[start:start+n_frames] - clock[start]
+        # fit out the drift between the paqio and PrairieView clocks
+        slope, intercept = np.polyfit(frame_times, chunk, 1)
+        error = np.max(np.abs(chunk - (slope * frame_times + intercept)))
+        if error < max_error:
+            best_start, max_error = start, error
+
+    if best_start is None:
+        return None, np.inf, False
+
+    tseries_clock = frame_clock[best_start:best_start+n_frames]
+
+    return tseries_clock, max_error, max_error <= tolerance
+
+
 def flu_splitter(flu, clock, t_starts, pre_frames, post_frames):
     '''Split a fluoresence matrix into trial by trial array
 
@@ -743,21 +817,15 @@ def raster_plot(arr, y_pos=1, color=np.random.rand(3,), alpha=1,
              label=label)
 
 
-def get_spiral_start(x_galvo, debounce_time):
-    
-    """ Get the sample at which the first spiral in a trial began 
-    
-    Experimental function involving lots of magic numbers
-    to detect spiral onsets.
-    Failures should be caught by assertion at end
-    Inputs:
-    x_galvo -- x_galvo signal recorded in paqio
-    debouce_time -- length of time (samples) encapulsating a whole trial
-                    ensures only spiral at start of trial is captured
-    
-    """
+def _spiral_onsets(x_galvo):
+
+    """ Full rate spiral detection on a stretch of x_galvo (see
+        get_spiral_start). Returns the samples at which spirals
+        and square pulses began, relative to the start of x_galvo
+        """
+
     #x_galvo = np.round(x_galvo, 2)
-    x_galvo = my_floor(x_galvo, 2)
+    x_galvo = my_floor(np.asarray(x_galvo), 2)
     
     # Threshold above which to determine signal as onset of square pulse
     square_thresh = 0.02
@@ -775,6 +843,71 @@ def get_spiral_start(x_galvo, debounce_time):
     
     # detect onset of sprials
     spiral_start = threshold_detect(diffed, diff_thresh)
+    square_start = threshold_detect(x_galvo, -0.5)
+
+    return spiral_start, square_start
+
+
+def get_spiral_start(x_galvo, debounce_time, pyramid=None, factor=16):
+    
+    """ Get the sample at which the first spiral in a trial began 
+    
+    Experimental function involving lots of magic numbers
+    to detect spiral onsets.
+    Failures should be caught by assertion at end
+    Inputs:
+    x_galvo -- x_galvo signal recorded in paqio
+    debouce_time -- length of time (samples) encapulsating a whole trial
+                    ensures only spiral at start of trial is captured
+    pyramid -- min/max pyramid of x_galvo (paq2py.minmax_pyramid or
+               PaqFile.pyramid), built here if not given
+    factor -- factor the pyramid was built with
+
+    Runs coarse-to-fine: the pyramid gives the stretches where the galvo
+    leaves its parked position and the full rate detection only runs on
+    those, padded and aligned to the smoothing windows so the result is the
+    same as running over the whole signal
+    
+    """
+
+    window_size = 200  # non_zero_smoother window
+
+    if pyramid is None:
+        pyramid = minmax_pyramid(x_galvo, factor=factor)
+
+    # coarse pass, blocks in which the galvo is not parked (< -0.5 V)
+    level = min(1, len(pyramid) - 1)
+    block = factor ** (level + 1)
+    active = pyramid[level][:, 1] > -0.51
+
+    # pad each stretch so it starts and ends with a parked smoothing window
+    pad = -(-2 * window_size // block) + 1
+    active = np.convolve(active, np.ones(2 * pad + 1), mode='same') > 0
+    active_edges = np.diff(np.concatenate(([0], active.astype(int), [0])))
+    seg_starts = np.flatnonzero(active_edges == 1) * block
+    seg_stops = np.flatnonzero(active_edges == -1) * block
+
+    seg_starts = seg_starts // window_size * window_size
+    seg_stops = np.minimum(-(-seg_stops // window_size) * window_size + 1,
+                           len(x_galvo))
+
+    segments = []
+    for start, stop in zip(seg_starts, seg_stops):
+        if segments and start <= segments[-1][1]:
+            segments[-1][1] = max(stop, segments[-1][1])
+        else:
+            segments.append([start, stop])
+
+    # fine pass, full rate detection only around candidate spirals
+    spiral_start = []
+    n_squares = 0
+    for start, stop in segments:
+        spirals, squares = _spiral_onsets(x_galvo[start:stop])
+        spiral_start.append(spirals + start)
+        n_squares += len(squares)
+
+    if spiral_start:
+        spiral_start = np.concatenate(spiral_start)
     
     if len(spiral_start) == 0:
         print('No spirals found')
@@ -782,7 +915,6 @@ def get_spiral_start(x_galvo, debounce_time):
     else:
         # Debounce to remove spirals that are not the onset of the trial
         spiral_start = spiral_start[np.hstack((np.inf, np.diff(spiral_start))) > debounce_time]
-        n_squares = len(threshold_detect(x_galvo, -0.5))
         assert len(spiral_start) == n_squares, \
         'spiral_start has len {} but there are {} square pulses'.format(len(spiral_start), n_squares)
         return spiral_start